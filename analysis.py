@@ -1,15 +1,48 @@
 import os
 import time
 import json
+import asyncio
+import hashlib
+import re
+import shutil
+import subprocess
+import tempfile
+from collections import deque
+import cv2
 from dotenv import load_dotenv
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from common import ITEM_KEYS, file_sha256, parse_timestamp
 
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY not set in .env file")
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "analysis_cache")
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", 7 * 24 * 3600))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# The clip Gemini sees is a small re-encode of the upload (see make_analysis_proxy)
+PROXY_SETTINGS = {
+    "height": int(os.getenv("ANALYSIS_PROXY_HEIGHT", 480)),
+    "fps": float(os.getenv("ANALYSIS_PROXY_FPS", 15)),
+    "bitrate": os.getenv("ANALYSIS_PROXY_BITRATE", "1M"),
+}
+
+# Longer videos are analysed in overlapping windows (see analyze_video)
+ANALYSIS_WINDOW_SECONDS = float(os.getenv("ANALYSIS_WINDOW_SECONDS", 300))
+ANALYSIS_WINDOW_OVERLAP = float(os.getenv("ANALYSIS_WINDOW_OVERLAP", 20))
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", 4))
+
+# Longest wait for Gemini to finish processing an upload
+PROCESSING_TIMEOUT = float(os.getenv("GEMINI_PROCESSING_TIMEOUT", 600))
+
+MODEL_NAME = "gemini-2.5-flash"
+GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "top_p": 0.8,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+}
 
 SPORT_PROMPTS = {
     "basketball": """
@@ -75,41 +108,50 @@ Output MUST be valid JSON in this format:
 """
 }
 
-def _validate_basketball(data):
+def _validate_basketball_shot(i, shot):
     required_fields = ["timestamp", "shot_type", "result", "total_shots_made_so_far",
                        "total_shots_missed_so_far", "total_layups_made_so_far", "feedback"]
+    for field in required_fields:
+        if field not in shot:
+            raise ValueError(f"Shot {i} missing required field: {field}")
+    if shot["result"] not in ["made", "missed"]:
+        raise ValueError(f"Shot {i} has invalid result: {shot['result']}")
+
+def _validate_basketball(data):
     if "shots" not in data:
         raise ValueError("Output must contain 'shots' array")
     for i, shot in enumerate(data["shots"]):
-        for field in required_fields:
-            if field not in shot:
-                raise ValueError(f"Shot {i} missing required field: {field}")
-        if shot["result"] not in ["made", "missed"]:
-            raise ValueError(f"Shot {i} has invalid result: {shot['result']}")
+        _validate_basketball_shot(i, shot)
     print("✓ Basketball output validation passed")
 
-def _validate_soccer(data):
+def _validate_soccer_event(i, event):
     required_fields = ["timestamp", "event_type", "player_action", "feedback"]
+    for field in required_fields:
+        if field not in event:
+            raise ValueError(f"Event {i} missing required field: {field}")
+    if event["event_type"] not in ["goal", "missed_shot", "pass", "foul"]:
+        raise ValueError(f"Event {i} has invalid type: {event['event_type']}")
+
+def _validate_soccer(data):
     if "events" not in data:
         raise ValueError("Output must contain 'events' array")
     for i, event in enumerate(data["events"]):
-        for field in required_fields:
-            if field not in event:
-                raise ValueError(f"Event {i} missing required field: {field}")
-        if event["event_type"] not in ["goal", "missed_shot", "pass", "foul"]:
-            raise ValueError(f"Event {i} has invalid type: {event['event_type']}")
+        _validate_soccer_event(i, event)
     print("✓ Soccer output validation passed")
 
-def _validate_tennis(data):
+def _validate_tennis_shot(i, shot):
     required_fields = ["timestamp", "shot_type", "result", "feedback"]
+    for field in required_fields:
+        if field not in shot:
+            raise ValueError(f"Shot {i} missing required field: {field}")
+    if shot["result"] not in ["winner", "error", "in_play"]:
+        raise ValueError(f"Shot {i} has invalid result: {shot['result']}")
+
+def _validate_tennis(data):
     if "shots" not in data:
         raise ValueError("Output must contain 'shots' array")
     for i, shot in enumerate(data["shots"]):
-        for field in required_fields:
-            if field not in shot:
-                raise ValueError(f"Shot {i} missing required field: {field}")
-        if shot["result"] not in ["winner", "error", "in_play"]:
-            raise ValueError(f"Shot {i} has invalid result: {shot['result']}")
+        _validate_tennis_shot(i, shot)
     print("✓ Tennis output validation passed")
 
 VALIDATORS = {
@@ -118,18 +160,149 @@ VALIDATORS = {
     "tennis": _validate_tennis
 }
 
-def analyze_video(video_path, sport, output_path):
-    """Analyze video using Gemini AI based on sport type"""
+ITEM_VALIDATORS = {
+    "basketball": _validate_basketball_shot,
+    "soccer": _validate_soccer_event,
+    "tennis": _validate_tennis_shot
+}
+
+class AnalysisCache:
+    """Validated analysis results on disk, one JSON file per key
+
+    Entries older than ttl seconds are ignored and removed. Once the
+    directory holds more than max_bytes, the oldest entries go first.
+    Writes go through a temporary file and a rename, so concurrent workers
+    never see a partial entry.
+    """
+
+    def __init__(self, directory=ANALYSIS_CACHE_DIR, ttl=ANALYSIS_CACHE_TTL, max_bytes=ANALYSIS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(video_hash, sport, input_settings=None):
+        """Everything that changes the model's answer: the video as uploaded, the prompt and the model settings"""
+        prompt_hash = hashlib.sha256(SPORT_PROMPTS[sport].encode('utf-8')).hexdigest()
+        payload = json.dumps([video_hash, sport, prompt_hash, MODEL_NAME, GENERATION_CONFIG, input_settings],
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+analysis_cache = AnalysisCache()
+
+def transcode_for_analysis(video_path, output_path, settings=None, start=None, duration=None):
+    """Re-encode video_path (or the [start, start + duration) span of it) to H.264 with ffmpeg
+
+    With settings, the video is scaled down to settings['height'] (never
+    up), resampled to settings['fps'] and encoded at settings['bitrate'];
+    without, it keeps its size and frame rate at near-lossless quality.
+    Frames are only dropped, never retimed, so a timestamp in the output
+    plus start is the same moment in the original. Raises
+    subprocess.CalledProcessError, or FileNotFoundError without ffmpeg.
+    """
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error']
+    if start is not None:
+        cmd += ['-ss', f"{start:.3f}", '-t', f"{duration:.3f}"]
+    cmd += ['-i', video_path]
+    if settings is not None:
+        video_filter = f"fps={settings['fps']},scale=-2:min({settings['height']}\\,ih)"
+        cmd += ['-vf', video_filter, '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', settings['bitrate']]
+    else:
+        cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18']
+    cmd += ['-c:a', 'aac', '-b:a', '64k', '-ac', '1', '-movflags', '+faststart', output_path]
+    subprocess.run(cmd, check=True, capture_output=True)
+    return output_path
+
+def make_analysis_proxy(video_path, settings=PROXY_SETTINGS):
+    """Transcode video_path into a small H.264 copy for upload (see transcode_for_analysis)
+
+    Returns the proxy path, or None when the original should be uploaded
+    instead (no ffmpeg, transcode failed, or the proxy isn't smaller).
+    """
+    fd, proxy_path = tempfile.mkstemp(suffix='.mp4')
+    os.close(fd)
+
+    try:
+        transcode_for_analysis(video_path, proxy_path, settings)
+    except subprocess.CalledProcessError as e:
+        print(f"Warning: Could not create analysis proxy, uploading the original: {e.stderr.decode()}")
+        os.remove(proxy_path)
+        return None
+    except FileNotFoundError:
+        print("Warning: ffmpeg not found, uploading the original video")
+        os.remove(proxy_path)
+        return None
+
+    original_size = os.path.getsize(video_path)
+    proxy_size = os.path.getsize(proxy_path)
+    if proxy_size >= original_size:
+        print("Analysis proxy is no smaller than the original, uploading the original")
+        os.remove(proxy_path)
+        return None
+
+    print(f"Analysis proxy: {proxy_size / 1e6:.1f} MB (original {original_size / 1e6:.1f} MB)")
+    return proxy_path
+
+def create_model():
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY not set in .env file")
+
     genai.configure(api_key=GEMINI_API_KEY)
 
-    model = genai.GenerativeModel(
-        model_name="gemini-2.5-flash",
-        generation_config={
-            "temperature": 0.1,
-            "top_p": 0.8,
-            "top_k": 40,
-            "max_output_tokens": 8192,
-        },
+    return genai.GenerativeModel(
+        model_name=MODEL_NAME,
+        generation_config=GENERATION_CONFIG,
         safety_settings={
             HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
             HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -138,67 +311,456 @@ def analyze_video(video_path, sport, output_path):
         }
     )
 
+_model = None
+
+def get_model():
+    """The configured Gemini model, created once per process"""
+    global _model
+    if _model is None:
+        _model = create_model()
+    return _model
+
+def parse_analysis_response(response_text):
+    """Pull the JSON object out of the model's reply, with or without code fences"""
+    response_text = response_text.strip()
+    if response_text.startswith("```json"):
+        response_text = response_text.replace("```json", "").replace("```", "").strip()
+    elif response_text.startswith("```"):
+        response_text = response_text.replace("```", "").strip()
+
     try:
-        print(f"Uploading video: {video_path}")
-        video_file = genai.upload_file(path=video_path)
-        print(f"Video uploaded: {video_file.name}")
+        return json.loads(response_text)
+    except json.JSONDecodeError:
+        start_idx = response_text.find('{')
+        end_idx = response_text.rfind('}') + 1
+        if start_idx != -1 and end_idx != -1:
+            return json.loads(response_text[start_idx:end_idx])
+        raise ValueError("Could not extract valid JSON from response")
+
+class AnalysisCancelled(Exception):
+    """Raised when an analysis is stopped through its cancel_event"""
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise AnalysisCancelled("Analysis was cancelled")
+
+class FileProcessingPoller:
+    """Waits for uploaded files to leave the PROCESSING state
+
+    Callers await poll() on their event loop, so any number of uploads are
+    polled from one loop without a thread held for each; genai.get_file
+    runs on the loop's executor only for the request itself.
+
+    The first check comes after about half the expected processing time,
+    estimated from the file size and the throughput seen on earlier files,
+    and the interval then grows by half each time up to max_interval. A wait
+    raises TimeoutError at its deadline and stops early when cancelled,
+    by task.cancel() or by setting cancel_event (AnalysisCancelled).
+    stats() summarises how long the recent files took to process.
+    """
+
+    def __init__(self, timeout=PROCESSING_TIMEOUT, min_interval=0.25, max_interval=5.0, bytes_per_second=2e6):
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.bytes_per_second = bytes_per_second
+        self.processing_seconds = deque(maxlen=100)
+
+    async def poll(self, video_file, size_bytes, timeout=None, cancel_event=None):
+        """Return video_file once Gemini has finished processing it"""
+        if video_file.state.name != "PROCESSING":
+            return video_file
+        start = time.perf_counter()
+        deadline = start + (timeout or self.timeout)
+        interval = size_bytes / self.bytes_per_second / 2
+        interval = min(self.max_interval, max(self.min_interval, interval))
 
         while video_file.state.name == "PROCESSING":
-            print("Processing video...")
-            time.sleep(2)
-            video_file = genai.get_file(video_file.name)
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f"Video processing did not finish within {timeout or self.timeout:.0f}s")
+            await asyncio.sleep(min(interval, remaining))
+            check_cancelled(cancel_event)
+            video_file = await asyncio.to_thread(genai.get_file, video_file.name)
+            interval = min(self.max_interval, interval * 1.5)
+
+        elapsed = time.perf_counter() - start
+        self.processing_seconds.append(elapsed)
+        self.bytes_per_second = 0.7 * self.bytes_per_second + 0.3 * (size_bytes / elapsed)
+        return video_file
+
+    def stats(self):
+        times = list(self.processing_seconds)
+        return {
+            'files': len(times),
+            'mean_seconds': round(sum(times) / len(times), 2) if times else 0.0,
+            'max_seconds': round(max(times), 2) if times else 0.0
+        }
+
+file_poller = FileProcessingPoller()
+
+class StreamingItemParser:
+    """Pulls each complete object out of the response's items array as the text arrives
+
+    feed() takes the next piece of the response and returns the items whose
+    closing brace it contained. Only string and bracket state is tracked,
+    so each character is looked at once.
+    """
+
+    def __init__(self, items_key):
+        self.array_start = re.compile(r'"%s"\s*:\s*\[' % re.escape(items_key))
+        self.text = ''
+        self.pos = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.item_start = None
+        self.done = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        items = []
+        if self.pos is None:
+            match = self.array_start.search(self.text)
+            if not match:
+                return items
+            self.pos = match.end()
+
+        text = self.text
+        while self.pos < len(text) and not self.done:
+            char = text[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                if self.depth == 0 and char == '{':
+                    self.item_start = self.pos
+                self.depth += 1
+            elif char in '}]':
+                if self.depth == 0:
+                    self.done = True
+                else:
+                    self.depth -= 1
+                    if self.depth == 0 and char == '}':
+                        try:
+                            items.append(json.loads(text[self.item_start:self.pos + 1]))
+                        except json.JSONDecodeError:
+                            pass
+            self.pos += 1
+        return items
+
+def stream_analysis(model, contents, sport, on_item):
+    """generate_content with stream=True, passing each validated item to on_item as soon as it closes
+
+    Returns the full response text, for the usual parse and validation.
+    """
+    parser = StreamingItemParser(ITEM_KEYS[sport])
+    validate_item = ITEM_VALIDATORS[sport]
+    start = time.perf_counter()
+    count = 0
+    for chunk in model.generate_content(contents, stream=True):
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        for item in parser.feed(text):
+            try:
+                validate_item(count, item)
+            except ValueError as e:
+                print(f"Warning: Skipping streamed item: {e}")
+                continue
+            if count == 0:
+                print(f"First item after {time.perf_counter() - start:.1f}s")
+            count += 1
+            try:
+                on_item(item)
+            except Exception as e:
+                print(f"Warning: Item callback failed: {e}")
+    return parser.text
+
+async def aanalyze_clip(model, clip_path, sport, on_item=None, cancel_event=None):
+    """Upload one clip, wait for Gemini to process it and return the validated analysis
+
+    The blocking Gemini calls run on the event loop's executor; the wait
+    for processing is polled on the loop itself (see FileProcessingPoller).
+    With on_item, the response is streamed and each shot/event is passed to
+    on_item as soon as it is complete (see stream_analysis). Setting
+    cancel_event stops the clip before the upload, while Gemini is
+    processing it, or before the model is asked, with AnalysisCancelled.
+    """
+    check_cancelled(cancel_event)
+    print(f"Uploading video: {clip_path}")
+    size_bytes = os.path.getsize(clip_path)
+    upload_start = time.perf_counter()
+    video_file = await asyncio.to_thread(genai.upload_file, path=clip_path)
+    print(f"Video uploaded: {video_file.name} "
+          f"({size_bytes / 1e6:.1f} MB in {time.perf_counter() - upload_start:.1f}s)")
+
+    try:
+        print("Processing video...")
+        processing_start = time.perf_counter()
+        video_file = await file_poller.poll(video_file, size_bytes, cancel_event=cancel_event)
 
         if video_file.state.name == "FAILED":
             raise ValueError(f"Video processing failed: {video_file.state}")
 
-        print("Video processing complete!")
+        stats = file_poller.stats()
+        print(f"Video processing complete! (waited {time.perf_counter() - processing_start:.1f}s; "
+              f"{stats['files']} recent files: mean {stats['mean_seconds']:.1f}s, max {stats['max_seconds']:.1f}s)")
+        check_cancelled(cancel_event)
         print("Analyzing video with Gemini...")
 
         prompt = SPORT_PROMPTS[sport]
-        response = model.generate_content([video_file, prompt])
-        response_text = response.text.strip()
-        print(f"Raw response: {response_text[:500]}...")
-
-        if response_text.startswith("```json"):
-            response_text = response_text.replace("```json", "").replace("```", "").strip()
-        elif response_text.startswith("```"):
-            response_text = response_text.replace("```", "").strip()
+        if on_item is None:
+            response = await asyncio.to_thread(model.generate_content, [video_file, prompt])
+            response_text = response.text
+        else:
+            response_text = await asyncio.to_thread(stream_analysis, model, [video_file, prompt], sport, on_item)
+        print(f"Raw response: {response_text.strip()[:500]}...")
+
+        analysis_data = parse_analysis_response(response_text)
+        VALIDATORS[sport](analysis_data)
+        return analysis_data
+    finally:
+        await asyncio.to_thread(genai.delete_file, video_file.name)
+        print("Cleaned up uploaded video file")
 
-        try:
-            analysis_data = json.loads(response_text)
-        except json.JSONDecodeError:
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            if start_idx != -1 and end_idx != -1:
-                analysis_data = json.loads(response_text[start_idx:end_idx])
+def analyze_clip(model, clip_path, sport, on_item=None, cancel_event=None):
+    """aanalyze_clip for callers outside an event loop"""
+    return asyncio.run(aanalyze_clip(model, clip_path, sport, on_item, cancel_event))
+
+def video_duration(video_path):
+    """Length of the video in seconds, or 0 if it can't be read"""
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    cap.release()
+    return frames / fps if fps > 0 else 0
+
+def check_window_settings(window_seconds, overlap_seconds):
+    """Raise ValueError unless windows of window_seconds overlapping by overlap_seconds move forward"""
+    if window_seconds <= 0 or not 0 <= overlap_seconds < window_seconds:
+        raise ValueError(f"Analysis windows must be longer than their overlap, got {window_seconds:g}s windows "
+                         f"overlapping by {overlap_seconds:g}s (ANALYSIS_WINDOW_SECONDS, ANALYSIS_WINDOW_OVERLAP)")
+
+def analysis_windows(duration, window_seconds, overlap_seconds):
+    """Split [0, duration) into overlapping (start, end, keep_from, keep_until) windows
+
+    Neighbouring windows overlap by overlap_seconds and hand over in the
+    middle of the overlap: events a window reports outside
+    [keep_from, keep_until) belong to its neighbour.
+    """
+    check_window_settings(window_seconds, overlap_seconds)
+    step = window_seconds - overlap_seconds
+    starts = [0.0]
+    while starts[-1] + window_seconds < duration:
+        starts.append(starts[-1] + step)
+
+    windows = []
+    for i, start in enumerate(starts):
+        end = min(start + window_seconds, duration)
+        keep_from = start + overlap_seconds / 2 if i > 0 else 0.0
+        keep_until = starts[i + 1] + overlap_seconds / 2 if i + 1 < len(starts) else float('inf')
+        windows.append((start, end, keep_from, keep_until))
+    return windows
+
+def format_timestamp(seconds):
+    minutes, seconds = divmod(round(seconds, 1), 60)
+    return f"{int(minutes)}:{seconds:04.1f}"
+
+def merge_window_results(sport, window_results, dedupe_seconds=1.5):
+    """Combine per-window analyses into one, as if the model had seen the whole video
+
+    window_results is a list of ((start, end, keep_from, keep_until), data).
+    Timestamps are shifted by each window's start, items outside a window's
+    keep range are dropped, and an item within dedupe_seconds of one from
+    the neighbouring window with the same outcome is treated as the same
+    one. Running totals are recomputed over the merged list.
+    """
+    items_key = ITEM_KEYS[sport]
+    outcome_key = 'event_type' if sport == 'soccer' else 'result'
+
+    merged = []
+    for window_index, ((start, _, keep_from, keep_until), data) in enumerate(window_results):
+        for item in data[items_key]:
+            item = dict(item)
+            seconds = start + parse_timestamp(item['timestamp'])
+            if not keep_from <= seconds < keep_until:
+                continue
+            for field in item:
+                if field.startswith('timestamp') and isinstance(item[field], str):
+                    item[field] = format_timestamp(start + parse_timestamp(item[field]))
+            merged.append((seconds, window_index, item))
+    merged.sort(key=lambda entry: entry[0])
+
+    items = []
+    last = None
+    for seconds, window_index, item in merged:
+        if (last is not None and last[1] != window_index and seconds - last[0] <= dedupe_seconds
+                and last[2][outcome_key] == item[outcome_key]):
+            continue
+        items.append(item)
+        last = (seconds, window_index, item)
+
+    if sport == 'basketball':
+        made = missed = layups_made = 0
+        for shot in items:
+            if shot['result'] == 'made':
+                made += 1
+                if 'layup' in shot['shot_type'].lower():
+                    layups_made += 1
             else:
-                raise ValueError("Could not extract valid JSON from response")
+                missed += 1
+            shot['total_shots_made_so_far'] = made
+            shot['total_shots_missed_so_far'] = missed
+            shot['total_layups_made_so_far'] = layups_made
+
+    return {items_key: items}
+
+def analyze_windows(model, video_path, sport, windows, proxy_settings, max_workers, on_item=None, cancel_event=None):
+    """Analyse up to max_workers windows of the video at a time and merge the results
+
+    The windows run as tasks on one event loop; if one fails, the others
+    are cancelled.
+
+    on_item gets streamed items with timestamps already shifted to the full
+    video. Running totals are only fixed up in the merged result, and an
+    item seen by two overlapping windows may be passed twice.
+    """
+    temp_dir = tempfile.mkdtemp()
+
+    def window_callback(window):
+        start, _, keep_from, keep_until = window
+
+        def on_window_item(item):
+            seconds = start + parse_timestamp(item['timestamp'])
+            if keep_from <= seconds < keep_until:
+                on_item(dict(item, timestamp=format_timestamp(seconds)))
+        return on_window_item
+
+    async def analyze_window(index, window, slots):
+        async with slots:
+            check_cancelled(cancel_event)
+            start, end = window[:2]
+            clip_path = os.path.join(temp_dir, f"window_{index}.mp4")
+            await asyncio.to_thread(transcode_for_analysis, video_path, clip_path, proxy_settings, start, end - start)
+            print(f"Window {index + 1}/{len(windows)}: {format_timestamp(start)}-{format_timestamp(end)}")
+            return await aanalyze_clip(model, clip_path, sport, window_callback(window) if on_item else None,
+                                       cancel_event)
+
+    async def analyze_all():
+        # Every window's processing wait is polled on this one loop
+        slots = asyncio.Semaphore(max_workers)
+        tasks = [asyncio.ensure_future(analyze_window(i, window, slots)) for i, window in enumerate(windows)]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    try:
+        window_results = list(zip(windows, asyncio.run(analyze_all())))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return merge_window_results(sport, window_results)
+
+def analyze_video(video_path, sport, output_path, video_hash=None, use_cache=True, proxy_settings=PROXY_SETTINGS,
+                  window_seconds=ANALYSIS_WINDOW_SECONDS, window_overlap=ANALYSIS_WINDOW_OVERLAP,
+                  max_workers=ANALYSIS_WORKERS, model=None, on_item=None, cancel_event=None):
+    """Analyze video using Gemini AI based on sport type
+
+    Results are kept in analysis_cache, keyed by the video's content hash
+    (video_hash, if the caller already computed it), the sport, the prompt
+    text and the model settings, so resubmitting a clip skips Gemini.
+    use_cache=False always asks the model and refreshes the cached entry.
+
+    Unless proxy_settings is None, a reduced copy of the video is uploaded
+    instead of the original (see make_analysis_proxy).
+
+    Videos longer than window_seconds are cut into windows that overlap by
+    window_overlap seconds, analysed up to max_workers at a time and merged
+    (see merge_window_results), which keeps each response well inside the
+    output token limit. window_seconds=None always sends the whole video.
+
+    model defaults to the configured Gemini model; anything with a
+    compatible generate_content can be passed instead.
+
+    With on_item, the response is streamed and on_item is called with each
+    validated shot/event as soon as the model has written it, so work such
+    as speech synthesis can start before the analysis is finished. Cached
+    results don't call on_item.
+
+    Setting cancel_event (a threading or multiprocessing Event) stops the
+    analysis with AnalysisCancelled; see analyze_clip.
+    """
+    if window_seconds:
+        check_window_settings(window_seconds, window_overlap)
+    window_settings = [window_seconds, window_overlap] if window_seconds else None
+    cache_key = AnalysisCache.key(video_hash or file_sha256(video_path), sport, [proxy_settings, window_settings])
+    if use_cache:
+        analysis_data = analysis_cache.get(cache_key)
+        if analysis_data is not None:
+            with open(output_path, 'w') as f:
+                json.dump(analysis_data, f, indent=2)
+            print(f"Using cached analysis. Results saved to: {output_path}")
+            return analysis_data
+
+    if model is None:
+        model = get_model()
+
+    proxy_path = None
+    try:
+        duration = video_duration(video_path) if window_seconds else 0
+        if window_seconds and duration > window_seconds and shutil.which('ffmpeg'):
+            windows = analysis_windows(duration, window_seconds, window_overlap)
+            print(f"Analysing {duration:.0f}s of video in {len(windows)} windows")
+            analysis_data = analyze_windows(model, video_path, sport, windows, proxy_settings, max_workers, on_item,
+                                            cancel_event)
+        else:
+            if proxy_settings is not None:
+                proxy_path = make_analysis_proxy(video_path, proxy_settings)
+            analysis_data = analyze_clip(model, proxy_path or video_path, sport, on_item, cancel_event)
 
         VALIDATORS[sport](analysis_data)
+        analysis_cache.put(cache_key, analysis_data)
 
         with open(output_path, 'w') as f:
             json.dump(analysis_data, f, indent=2)
 
         print(f"Analysis complete! Results saved to: {output_path}")
-        genai.delete_file(video_file.name)
-        print("Cleaned up uploaded video file")
-
         return analysis_data
 
     except Exception as e:
         print(f"Error during analysis: {e}")
         raise
 
+    finally:
+        if proxy_path:
+            os.remove(proxy_path)
+
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) < 4:
-        print("Usage: python analysis.py <video_path> <sport> <output_path>")
+    use_cache = "--no-cache" not in sys.argv
+    proxy_settings = None if "--no-proxy" in sys.argv else PROXY_SETTINGS
+    args = [arg for arg in sys.argv[1:] if arg not in ("--no-cache", "--no-proxy")]
+
+    if len(args) < 3:
+        print("Usage: python analysis.py <video_path> <sport> <output_path> [--no-cache] [--no-proxy]")
         print("Example: python analysis.py final_ball.mp4 basketball sports.json")
         sys.exit(1)
 
-    video_path = sys.argv[1]
-    sport = sys.argv[2]
-    output_path = sys.argv[3]
+    video_path = args[0]
+    sport = args[1]
+    output_path = args[2]
 
-    analyze_video(video_path, sport, output_path)
+    analyze_video(video_path, sport, output_path, use_cache=use_cache, proxy_settings=proxy_settings)
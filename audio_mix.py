@@ -0,0 +1,67 @@
+import subprocess
+import wave
+import numpy as np
+
+SAMPLE_RATE = 44100
+
+def decode_audio(path, sample_rate=SAMPLE_RATE):
+    """Decode an audio file to mono float32 PCM using ffmpeg"""
+    cmd = ['ffmpeg', '-loglevel', 'error', '-i', path,
+           '-f', 'f32le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1']
+    result = subprocess.run(cmd, check=True, capture_output=True)
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+def mix_audio_timeline(clips, duration_seconds, output_path, sample_rate=SAMPLE_RATE, block_seconds=30):
+    """Mix (offset_seconds, audio_path) clips into one 16-bit mono WAV of duration_seconds
+
+    The timeline is mixed in fixed-size blocks. Each clip is decoded once, when
+    the block containing its start is reached, and dropped once it has been
+    fully mixed. Overlapping clips are summed and the result is clipped to
+    full scale. Memory use depends on the block size and the clips currently
+    playing, not on the video length. Time grows linearly with the total
+    audio length.
+    """
+    total_samples = int(round(duration_seconds * sample_rate))
+    clips = sorted(
+        (int(round(offset * sample_rate)), path)
+        for offset, path in clips
+        if 0 <= offset * sample_rate < total_samples
+    )
+
+    block_size = int(block_seconds * sample_rate)
+    block = np.empty(block_size, dtype=np.float32)
+    playing = []
+    next_clip = 0
+
+    with wave.open(output_path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+
+        for block_start in range(0, total_samples, block_size):
+            block_end = min(block_start + block_size, total_samples)
+            mixed = block[:block_end - block_start]
+            mixed.fill(0)
+
+            while next_clip < len(clips) and clips[next_clip][0] < block_end:
+                start, path = clips[next_clip]
+                next_clip += 1
+                try:
+                    playing.append((start, decode_audio(path, sample_rate)))
+                except subprocess.CalledProcessError as e:
+                    print(f"Warning: Could not decode audio clip {path}: {e.stderr.decode(errors='replace')}")
+
+            still_playing = []
+            for start, samples in playing:
+                lo = max(start, block_start)
+                hi = min(start + len(samples), block_end)
+                if lo < hi:
+                    mixed[lo - block_start:hi - block_start] += samples[lo - start:hi - start]
+                if start + len(samples) > block_end:
+                    still_playing.append((start, samples))
+            playing = still_playing
+
+            np.clip(mixed, -1.0, 1.0, out=mixed)
+            wav.writeframes((mixed * 32767).astype('<i2').tobytes())
+
+    return output_path
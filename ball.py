@@ -1,14 +1,29 @@
 import cv2
 import mediapipe as mp
 import numpy as np
+import bisect
+import hashlib
+import heapq
+import json
+import multiprocessing
 import time
 import os
+import queue
+import shutil
+import subprocess
 import tempfile
-from voice import generate_speech
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from audio_mix import mix_audio_timeline
+from common import file_sha256, parse_timestamp
+from voice import generate_speech, speech_cache, speech_key
 
-def parse_timestamp(timestamp):
-    minutes, seconds = timestamp.split(':')
-    return float(minutes) * 60 + float(seconds)
+POSE_CACHE_DIR = os.getenv("POSE_CACHE_DIR", "pose_cache")
+PREVIEW_HEIGHT = int(os.getenv("PREVIEW_HEIGHT", 360))
+PREVIEW_FPS = float(os.getenv("PREVIEW_FPS", 12))
+HLS_SEGMENT_SECONDS = float(os.getenv("HLS_SEGMENT_SECONDS", 2))
+MISSING_HEAD = np.iinfo(np.int32).min
 
 def timestamp_to_frame(timestamp, fps):
     seconds = parse_timestamp(timestamp)
@@ -52,41 +67,161 @@ def get_animation_color(elapsed_time, animation_duration, is_success):
         else:
             return (int(255 * ((progress - 0.5) * 2)), int(255 * ((progress - 0.5) * 2)), 255)
 
-def annotate_video(video_path, analysis_data, output_path, sport_type):
-    """Annotate video with analysis data based on sport type"""
+def open_video_writer(output_path, fps, width, height):
+    """Open a VideoWriter, falling back through codecs until one works"""
+    codecs_to_try = ['avc1', 'mp4v', 'XVID']
 
-    mp_pose = mp.solutions.pose
-    pose = mp_pose.Pose(min_detection_confidence=0.5, min_tracking_confidence=0.5)
+    out = None
+    for codec in codecs_to_try:
+        fourcc = cv2.VideoWriter_fourcc(*codec)
+        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        if out.isOpened():
+            print(f"Using codec: {codec}")
+            break
+        out.release()
 
-    cap = cv2.VideoCapture(video_path)
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if out is None or not out.isOpened():
+        raise RuntimeError("Failed to initialize video writer with any codec")
 
-    processed_frames = []
-    last_head = None
-    frame_count = 0
-    process_every_n_frames = max(1, int(fps / 20))
-    animation_duration = 1.25
-    last_event_time = None
-    last_event_result = None
-    current_color = (255, 255, 255)
+    return out
 
-    # Create temporary directory for audio files
-    temp_dir = tempfile.mkdtemp()
-    audio_files = []
+def ffmpeg_available():
+    return shutil.which('ffmpeg') is not None
+
+def build_audio_track(audio_files, fps, video_seconds, temp_dir):
+    """Mix the feedback clips into one WAV at their frame offsets
+
+    Returns the WAV path, or None when there is nothing to mix or no ffmpeg
+    to decode the clips.
+    """
+    if not audio_files:
+        return None
+    if not ffmpeg_available():
+        print("Warning: ffmpeg not found. Video saved without audio.")
+        return None
+
+    track_path = os.path.join(temp_dir, "feedback_mix.wav")
+    clips = [(frame_num / fps, audio_path) for frame_num, audio_path in audio_files]
+    return mix_audio_timeline(clips, video_seconds, track_path)
+
+class FFmpegWriter:
+    """Pipes raw BGR frames into a single ffmpeg process encoding with x264
+
+    Given audio_track (see build_audio_track), the feedback audio is muxed
+    by the same process, so the final file comes out in one pass with no
+    silent intermediate. Has the write/release/isOpened surface of
+    cv2.VideoWriter.
+    """
+
+    def __init__(self, output_path, fps, width, height, audio_track=None, preset='veryfast', threads=0):
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0']
+        if audio_track:
+            cmd += ['-i', audio_track, '-map', '0:v', '-map', '1:a', '-c:a', 'aac']
+        if width % 2 or height % 2:
+            # yuv420p needs even dimensions
+            cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        cmd += ['-c:v', 'libx264', '-preset', preset, '-threads', str(threads), '-pix_fmt', 'yuv420p']
+        cmd += self.output_args(output_path)
+
+        self.output_path = output_path
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self.stderr)
+        print(f"Using ffmpeg encoder: libx264 ({preset})")
+
+    def output_args(self, output_path):
+        return [output_path]
+
+    def isOpened(self):
+        return self.process.poll() is None
+
+    def write(self, frame):
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            self.release()
+
+    def release(self):
+        if self.process.stdin.closed:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        error_output = self.stderr.read().decode(errors='replace')
+        self.stderr.close()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {self.output_path}: {error_output}")
+
+class HLSWriter(FFmpegWriter):
+    """FFmpegWriter that writes an HLS event playlist of fragmented-MP4 segments
+
+    directory receives index.m3u8, init.mp4 and seg_00000.m4s onwards. Each
+    segment is renamed into place once complete and the playlist rewritten
+    after it, so the directory can be served while frames are still being
+    encoded. Keyframes are forced every segment_seconds so the segments cut
+    on time. Frames go straight into the ffmpeg pipe, so only x264's
+    lookahead and the current segment are ever buffered.
+    """
+
+    PLAYLIST = 'index.m3u8'
+
+    def __init__(self, directory, fps, width, height, audio_track=None, preset='veryfast', threads=0,
+                 segment_seconds=HLS_SEGMENT_SECONDS):
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(os.path.join(directory, self.PLAYLIST), fps, width, height, audio_track, preset, threads)
+
+    def output_args(self, output_path):
+        return ['-force_key_frames', f'expr:gte(t,n_forced*{self.segment_seconds:g})',
+                '-f', 'hls', '-hls_time', f'{self.segment_seconds:g}', '-hls_playlist_type', 'event',
+                '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', 'init.mp4',
+                '-hls_segment_filename', os.path.join(self.directory, 'seg_%05d.m4s'),
+                '-hls_flags', 'independent_segments+temp_file', output_path]
 
-    # Prepare events based on sport type
+def remux_progressive(playlist_path, output_path, audio_track=None):
+    """Copy a finished HLS render into one regular MP4, muxing in audio_track if given"""
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', playlist_path]
+    if audio_track:
+        cmd += ['-i', audio_track, '-map', '0:v', '-map', '1:a', '-c:v', 'copy', '-c:a', 'aac', '-shortest']
+    else:
+        cmd += ['-c', 'copy']
+    cmd.append(output_path)
+
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"ffmpeg failed to remux {playlist_path}: {e.stderr.decode(errors='replace')}")
+
+def open_frame_writer(output_path, fps, width, height, encoder='auto', encoder_options=None, audio_track=None):
+    """Open the frame sink for a render
+
+    encoder is 'ffmpeg' (x264 through a pipe, muxing in audio_track),
+    'opencv' (cv2.VideoWriter with the codec fallback, video only) or 'auto'
+    (ffmpeg when it is on PATH). Returns (writer, audio_muxed).
+    """
+    if encoder == 'auto':
+        encoder = 'ffmpeg' if ffmpeg_available() else 'opencv'
+    if encoder == 'ffmpeg':
+        if ffmpeg_available():
+            writer = FFmpegWriter(output_path, fps, width, height, audio_track, **(encoder_options or {}))
+            return writer, bool(audio_track)
+        print("Warning: ffmpeg not found. Falling back to OpenCV codecs.")
+    elif encoder != 'opencv':
+        raise ValueError(f"Unknown encoder: {encoder}")
+    return open_video_writer(output_path, fps, width, height), False
+
+def build_events(analysis_data, sport_type, fps):
+    """Turn analysis JSON into frame-indexed events and the (frame, text) feedback lines to speak"""
+    speech = []
     events = []
     if sport_type == "basketball":
-        for i, shot in enumerate(analysis_data.get('shots', [])):
+        for shot in analysis_data.get('shots', []):
             timestamp = shot.get('timestamp_of_outcome') or shot.get('timestamp')
-            audio_path = os.path.join(temp_dir, f"feedback_{i}.mp3")
-            try:
-                generate_speech(shot['feedback'], audio_path)
-                audio_files.append((timestamp_to_frame(timestamp, fps), audio_path))
-            except Exception as e:
-                print(f"Warning: Could not generate audio for feedback {i}: {e}")
+            speech.append((timestamp_to_frame(timestamp, fps), shot['feedback']))
 
             events.append({
                 'frame_number': timestamp_to_frame(timestamp, fps),
@@ -97,14 +232,9 @@ def annotate_video(video_path, analysis_data, output_path, sport_type):
                 'missed_count': shot.get('total_shots_missed_so_far', 0)
             })
     elif sport_type == "soccer":
-        for i, event in enumerate(analysis_data.get('events', [])):
+        for event in analysis_data.get('events', []):
             is_success = event['event_type'] == 'goal'
-            audio_path = os.path.join(temp_dir, f"feedback_{i}.mp3")
-            try:
-                generate_speech(event['feedback'], audio_path)
-                audio_files.append((timestamp_to_frame(event['timestamp'], fps), audio_path))
-            except Exception as e:
-                print(f"Warning: Could not generate audio for feedback {i}: {e}")
+            speech.append((timestamp_to_frame(event['timestamp'], fps), event['feedback']))
 
             events.append({
                 'frame_number': timestamp_to_frame(event['timestamp'], fps),
@@ -114,14 +244,9 @@ def annotate_video(video_path, analysis_data, output_path, sport_type):
                 'event_type': event['event_type']
             })
     elif sport_type == "tennis":
-        for i, shot in enumerate(analysis_data.get('shots', [])):
+        for shot in analysis_data.get('shots', []):
             is_success = shot['result'] == 'winner'
-            audio_path = os.path.join(temp_dir, f"feedback_{i}.mp3")
-            try:
-                generate_speech(shot['feedback'], audio_path)
-                audio_files.append((timestamp_to_frame(shot['timestamp'], fps), audio_path))
-            except Exception as e:
-                print(f"Warning: Could not generate audio for feedback {i}: {e}")
+            speech.append((timestamp_to_frame(shot['timestamp'], fps), shot['feedback']))
 
             events.append({
                 'frame_number': timestamp_to_frame(shot['timestamp'], fps),
@@ -131,226 +256,1353 @@ def annotate_video(video_path, analysis_data, output_path, sport_type):
                 'shot_type': shot['shot_type']
             })
 
-    print(f"Processing video: {video_path}")
-    print(f"Total events to annotate: {len(events)}")
+    return events, speech
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
+class SpeechJobs:
+    """Feedback clips being synthesised on a thread pool
 
-        frame_count += 1
+    Clips are submitted straight away, at most max_workers at a time, so the
+    TTS round-trips overlap with each other and with whatever the caller
+    does next. result() waits for all of them. cached is True when every
+    clip was already in the speech cache, so waiting costs nothing.
+    """
 
-        # Process pose detection
-        if frame_count % process_every_n_frames == 0:
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            results = pose.process(rgb_frame)
+    def __init__(self, speech, temp_dir, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self.futures = []
+        self.cache_counts = (speech_cache.hits, speech_cache.misses)
+        self.cached = all(speech_cache.contains(speech_key(text)) for _, text in speech)
+        for i, (frame_num, text) in enumerate(speech):
+            audio_path = os.path.join(temp_dir, f"feedback_{i}.mp3")
+            self.futures.append((frame_num, self.executor.submit(generate_speech, text, audio_path)))
+        self.audio_files = None
+
+    def result(self):
+        """Wait for every clip and return (frame, path) for the ones that were generated"""
+        if self.audio_files is None:
+            self.audio_files = []
+            for i, (frame_num, future) in enumerate(self.futures):
+                try:
+                    self.audio_files.append((frame_num, future.result()))
+                except Exception as e:
+                    print(f"Warning: Could not generate audio for feedback {i}: {e}")
+            self.executor.shutdown()
+            hits = speech_cache.hits - self.cache_counts[0]
+            misses = speech_cache.misses - self.cache_counts[1]
+            if hits or misses:
+                print(f"TTS cache: {hits} hits, {misses} misses")
+        return self.audio_files
+
+    def cancel(self):
+        """Drop clips that haven't started and don't wait for the rest"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class PoseInput:
+    """Reusable buffers that turn a BGR frame into the RGB image fed to MediaPipe
+
+    With pose_resolution set, frames are downscaled so their longer side is at
+    most that many pixels. Landmarks come back normalised to [0, 1], so they
+    map straight back onto the full-size frame.
+    """
+
+    def __init__(self, width, height, pose_resolution=None):
+        scale = min(1.0, pose_resolution / max(width, height)) if pose_resolution else 1.0
+        self.size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        self.resized = np.empty((self.size[1], self.size[0], 3), np.uint8) if scale < 1.0 else None
+        self.rgb = np.empty((self.size[1], self.size[0], 3), np.uint8)
+
+    def prepare(self, frame):
+        source = frame
+        if self.resized is not None:
+            cv2.resize(frame, self.size, dst=self.resized, interpolation=cv2.INTER_AREA)
+            source = self.resized
+        cv2.cvtColor(source, cv2.COLOR_BGR2RGB, dst=self.rgb)
+        return self.rgb
+
+def detect_head(pose, frame, width, height, pose_input=None):
+    """Run pose detection on a BGR frame and return the head position, if any"""
+    rgb_frame = pose_input.prepare(frame) if pose_input is not None else cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    results = pose.process(rgb_frame)
+
+    if results.pose_landmarks:
+        head = results.pose_landmarks.landmark[0]
+        return (int(head.x * width), int(head.y * height))
+    return None
+
+class ConstantVelocityFilter:
+    """Alpha-beta filter that smooths head positions and predicts between samples"""
+
+    def __init__(self, alpha=0.85, beta=0.3):
+        self.alpha = alpha
+        self.beta = beta
+        self.position = None
+        self.velocity = np.zeros(2)
+
+    def predict(self):
+        if self.position is not None:
+            self.position = self.position + self.velocity
+
+    def correct(self, measurement, elapsed=1):
+        """Fold in a measurement taken elapsed frames after the previous one"""
+        measurement = np.asarray(measurement, dtype=np.float64)
+        if self.position is None:
+            self.position = measurement
+            return
+        predicted = self.position + self.velocity
+        residual = measurement - predicted
+        self.position = predicted + self.alpha * residual
+        self.velocity = self.velocity + self.beta * residual / elapsed
+
+    def head(self):
+        if self.position is None:
+            return None
+        return (int(round(self.position[0])), int(round(self.position[1])))
+
+class HeadTracker:
+    """Decides which frames get pose detection and which head position each frame shows
+
+    In 'fixed' mode every process_every_n_frames-th frame is sent to MediaPipe
+    and the last detection is held in between, as before.
+
+    In 'adaptive' mode MediaPipe runs at that same stride only near events
+    or when a cheap thumbnail difference shows motion since the last sample.
+    Elsewhere it runs sparse_multiplier times less often. Between samples a
+    constant-velocity filter predicts the head position. pose_budget caps the
+    long-run call rate at that fraction of the fixed stride. Budget is banked
+    in quiet stretches, up to one full event window, and spent near events.
+    """
+
+    THUMBNAIL_SIZE = (64, 36)
+
+    def __init__(self, pose, width, height, process_every_n_frames, mode='fixed', fps=30,
+                 event_frames=(), pose_budget=0.5, pose_resolution=None, motion_threshold=6.0,
+                 sparse_multiplier=4, dense_before=0.5, dense_after=1.5, record=False):
+        if mode not in ('fixed', 'adaptive'):
+            raise ValueError(f"Unknown pose sampling mode: {mode}")
+
+        self.pose = pose
+        self.pose_input = PoseInput(width, height, pose_resolution)
+        self.width = width
+        self.height = height
+        self.stride = process_every_n_frames
+        self.mode = mode
+        self.last_head = None
+        self.calls = 0
+        self.fixed_calls = 0
+
+        self.pose_budget = pose_budget
+        self.motion_threshold = motion_threshold
+        self.sparse_stride = process_every_n_frames * sparse_multiplier
+        self.dense_windows = sorted(
+            (frame - int(dense_before * fps), frame + int(dense_after * fps)) for frame in event_frames)
+        self.dense_starts = [start for start, _ in self.dense_windows]
+        self.max_dense_length = max((end - start for start, end in self.dense_windows), default=0)
+        self.capacity = max(1.0, (dense_before + dense_after) * fps / process_every_n_frames)
+        self.tokens = self.capacity
+        self.filter = ConstantVelocityFilter()
+        self.last_sample_frame = None
+        self.reference = None
+        self.track = [] if record else None
+
+    def update(self, frame_count, frame):
+        """Return the head position to draw on this frame, running pose detection if needed"""
+        head = self._update(frame_count, frame)
+        if self.track is not None:
+            self.track.append(head)
+        return head
+
+    def _update(self, frame_count, frame):
+        is_stride_frame = frame_count % self.stride == 0
+        if is_stride_frame:
+            self.fixed_calls += 1
+
+        if self.mode == 'fixed':
+            if is_stride_frame:
+                self._detect(frame)
+            return self.last_head
+
+        self.tokens = min(self.capacity, self.tokens + self.pose_budget / self.stride)
+        thumbnail = cv2.resize(frame, self.THUMBNAIL_SIZE, interpolation=cv2.INTER_LINEAR).astype(np.int16)
+
+        if self.last_sample_frame is None:
+            wanted = True
+        else:
+            since = frame_count - self.last_sample_frame
+            if since >= self.sparse_stride:
+                wanted = True
+            elif since >= self.stride:
+                wanted = self._near_event(frame_count) or \
+                    np.abs(thumbnail - self.reference).mean() > self.motion_threshold
+            else:
+                wanted = False
+
+        if wanted and self.tokens >= 1:
+            self.tokens -= 1
+            elapsed = frame_count - self.last_sample_frame if self.last_sample_frame is not None else 1
+            self.last_sample_frame = frame_count
+            self.reference = thumbnail
+            head = self._detect(frame)
+            if head is not None:
+                self.filter.correct(head, elapsed)
+            else:
+                # Lost the player: stop extrapolating quickly
+                self.filter.predict()
+                self.filter.velocity *= 0.5
+        else:
+            self.filter.predict()
+
+        head = self.filter.head()
+        if head is None:
+            return None
+        return (min(max(head[0], 0), self.width - 1), min(max(head[1], 0), self.height - 1))
+
+    def _detect(self, frame):
+        self.calls += 1
+        head = detect_head(self.pose, frame, self.width, self.height, self.pose_input)
+        if head is not None:
+            self.last_head = head
+        return head
+
+    def _near_event(self, frame_count):
+        # Windows are sorted by start; only windows starting within the longest
+        # window length before frame_count can still cover it
+        i = bisect.bisect_right(self.dense_starts, frame_count)
+        while i > 0 and frame_count - self.dense_starts[i - 1] <= self.max_dense_length:
+            i -= 1
+            if frame_count <= self.dense_windows[i][1]:
+                return True
+        return False
+
+class PoseTrackPlayback:
+    """Stands in for HeadTracker by replaying a saved head track, without MediaPipe"""
+
+    def __init__(self, track, process_every_n_frames):
+        self.track = track
+        self.stride = process_every_n_frames
+        self.calls = 0
+        self.fixed_calls = 0
+
+    def update(self, frame_count, frame):
+        if frame_count % self.stride == 0:
+            self.fixed_calls += 1
+        if 1 <= frame_count <= len(self.track):
+            x, y = self.track[frame_count - 1]
+            if x != MISSING_HEAD:
+                return (int(x), int(y))
+        return None
+
+_pose_cache = threading.local()
+
+def get_pose():
+    """This thread's MediaPipe Pose graph
+
+    The graph is built on first use and reset before each later video, so
+    long-lived workers pay the model load once. Each thread gets its own,
+    as a graph can only follow one video at a time.
+    """
+    pose = getattr(_pose_cache, 'pose', None)
+    if pose is None:
+        pose = mp.solutions.pose.Pose(min_detection_confidence=0.5, min_tracking_confidence=0.5)
+        _pose_cache.pose = pose
+    else:
+        pose.reset()
+    return pose
+
+def open_head_tracker(fps, width, height, events, pose_options, pose_track_path=None, record=False):
+    """Return (tracker, pose) for a run; pose is None when a saved track is replayed"""
+    process_every_n_frames = max(1, int(fps / 20))
+    if pose_track_path is not None:
+        return PoseTrackPlayback(load_pose_track(pose_track_path), process_every_n_frames), None
+
+    pose = get_pose()
+    tracker = HeadTracker(pose, width, height, process_every_n_frames, mode=pose_options['pose_sampling'], fps=fps,
+                          event_frames=[event['frame_number'] for event in events],
+                          pose_budget=pose_options['pose_budget'], pose_resolution=pose_options['pose_resolution'],
+                          record=record)
+    return tracker, pose
+
+def resolve_pose_track(video_path, fps, pose_options, pose_cache='auto', video_hash=None):
+    """Return (track_path, saved_track) for a run's head track
+
+    track_path is where the track is saved (None with pose_cache='off');
+    saved_track is the path to replay, or None when the track has to be
+    computed. Raises FileNotFoundError for pose_cache='only' without one.
+    """
+    if pose_cache == 'off':
+        return None, None
+
+    track_path = pose_track_path(video_hash or file_sha256(video_path), fps, pose_options)
+    if pose_cache in ('auto', 'only') and os.path.exists(track_path):
+        print(f"Using saved pose track: {track_path}")
+        return track_path, track_path
+    if pose_cache == 'only':
+        raise FileNotFoundError(f"No saved pose track for {video_path} (expected {track_path})")
+    return track_path, None
+
+def pose_track_path(video_hash, fps, pose_options):
+    """Sidecar path for a video's head track, keyed by content hash and every pose parameter"""
+    params = dict(pose_options, process_every_n_frames=max(1, int(fps / 20)),
+                  min_detection_confidence=0.5, min_tracking_confidence=0.5, version=1)
+    key = hashlib.sha256(json.dumps([video_hash, params], sort_keys=True).encode()).hexdigest()
+    return os.path.join(POSE_CACHE_DIR, f"{key}.npy")
+
+def save_pose_track(path, heads):
+    """Write heads (one (x, y) or None per frame) as an int32 array, atomically"""
+    track = np.full((len(heads), 2), MISSING_HEAD, np.int32)
+    for i, head in enumerate(heads):
+        if head is not None:
+            track[i] = head
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        np.save(f, track)
+    os.replace(temp_path, path)
+
+def load_pose_track(path):
+    return np.load(path, mmap_mode='r')
+
+def draw_player_marker(frame, head):
+    head_x, head_y = head
+    arrow_height = 30
+    arrow_width = 45
+    arrow_tip_y = max(0, head_y - 110)
+    pt1 = (head_x, arrow_tip_y + arrow_height)
+    pt2 = (head_x - arrow_width // 2, arrow_tip_y)
+    pt3 = (head_x + arrow_width // 2, arrow_tip_y)
+    pts = np.array([pt1, pt2, pt3], np.int32).reshape((-1, 1, 2))
+    cv2.fillPoly(frame, [pts], (0, 0, 255))
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    text = "Player"
+    text_size = cv2.getTextSize(text, font, 0.8, 2)[0]
+    text_x = head_x - text_size[0] // 2
+    text_y = arrow_tip_y - 10
+    cv2.putText(frame, text, (text_x, text_y), font, 0.8, (0, 0, 0), 6, cv2.LINE_AA)
+    cv2.putText(frame, text, (text_x, text_y), font, 0.8, (255, 255, 255), 2, cv2.LINE_AA)
+
+def draw_basketball_stats(frame, current_stats, current_color, last_event_result):
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    scale = 0.8
+    thickness = 2
+    border_thickness = 4
+    spacing = 35
+    x = 20
+    y = 40
+
+    made = current_stats.get('made', 0)
+    missed = current_stats.get('missed', 0)
+
+    made_text = f"Shots Made: {made}"
+    cv2.putText(frame, made_text, (x, y), font, scale, (0, 0, 0), border_thickness, cv2.LINE_AA)
+    made_color = current_color if last_event_result == 'made' else (255, 255, 255)
+    cv2.putText(frame, made_text, (x, y), font, scale, made_color, thickness, cv2.LINE_AA)
+
+    missed_text = f"Shots Missed: {missed}"
+    cv2.putText(frame, missed_text, (x, y + spacing), font, scale, (0, 0, 0), border_thickness, cv2.LINE_AA)
+    missed_color = current_color if last_event_result == 'missed' else (255, 255, 255)
+    cv2.putText(frame, missed_text, (x, y + spacing), font, scale, missed_color, thickness, cv2.LINE_AA)
+
+def draw_feedback(frame, current_feedback, width, height):
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    scale = 0.6
+    thickness = 1
+    border_thickness = 3
+    max_width = int(width * 0.9)
+    wrapped_lines = wrap_text(current_feedback, font, scale, thickness, max_width)
+    feedback_text = current_feedback
+    text_size = cv2.getTextSize(feedback_text, font, scale, thickness)[0]
+
+    if text_size[0] > max_width:
+        # Calculate total height needed for all lines
+        line_height = 25
+        total_height = len(wrapped_lines) * line_height
+        feedback_y = height - 60 - total_height + line_height
+
+        for line in wrapped_lines:
+            text_size = cv2.getTextSize(line, font, scale, thickness)[0]
+            feedback_x = (width - text_size[0]) // 2
+            cv2.putText(frame, line, (feedback_x, feedback_y), font, scale, (0, 0, 0), border_thickness, cv2.LINE_AA)
+            cv2.putText(frame, line, (feedback_x, feedback_y), font, scale, (255, 255, 255), thickness, cv2.LINE_AA)
+            feedback_y += line_height
+    else:
+        feedback_x = (width - text_size[0]) // 2
+        feedback_y = height - 60
+        cv2.putText(frame, feedback_text, (feedback_x, feedback_y), font, scale, (0, 0, 0), border_thickness, cv2.LINE_AA)
+        cv2.putText(frame, feedback_text, (feedback_x, feedback_y), font, scale, (255, 255, 255), thickness, cv2.LINE_AA)
+
+class EventTimeline:
+    """Frame-indexed lookups over events, independent of how many events there are
+
+    Events are stably sorted by frame_number, so among events on the same
+    frame the later one in the analysis wins, as before. Feedback windows are
+    flattened up front into disjoint intervals, each owned by the most recent
+    event covering it, so both lookups are a single bisect.
+    """
+
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda e: e['frame_number'])
+        self.frames = [e['frame_number'] for e in self.events]
+
+        boundaries = sorted({e['frame_number'] for e in self.events} |
+                            {e['feedback_end_frame'] + 1 for e in self.events})
+        self.window_starts = []
+        self.window_ends = []
+        self.window_events = []
+
+        covering = []
+        next_event = 0
+        for i, boundary in enumerate(boundaries):
+            while next_event < len(self.events) and self.frames[next_event] <= boundary:
+                event = self.events[next_event]
+                heapq.heappush(covering, (-next_event, event['feedback_end_frame']))
+                next_event += 1
+            while covering and covering[0][1] < boundary:
+                heapq.heappop(covering)
+            if not covering or i + 1 == len(boundaries):
+                continue
+
+            owner = -covering[0][0]
+            end = boundaries[i + 1] - 1
+            if self.window_events and self.window_events[-1] == owner and self.window_ends[-1] == boundary - 1:
+                self.window_ends[-1] = end
+            else:
+                self.window_starts.append(boundary)
+                self.window_ends.append(end)
+                self.window_events.append(owner)
+
+    def last_fired(self, frame_count):
+        """Most recent event with frame_number <= frame_count, or None"""
+        i = bisect.bisect_right(self.frames, frame_count) - 1
+        return self.events[i] if i >= 0 else None
+
+    def active(self, frame_count):
+        """Most recent event whose feedback window contains frame_count, or None"""
+        i = bisect.bisect_right(self.window_starts, frame_count) - 1
+        if i >= 0 and frame_count <= self.window_ends[i]:
+            return self.events[self.window_events[i]]
+        return None
+
+class Sprite:
+    """A pre-rendered overlay, stored ready to blend onto a frame
+
+    inv_alpha holds 255 * (1 - coverage) and premultiplied holds
+    255 * colour * coverage per channel, so blending is one multiply-add.
+    """
+
+    def __init__(self, x, y, inv_alpha, premultiplied):
+        self.x = x
+        self.y = y
+        self.inv_alpha = inv_alpha
+        self.premultiplied = premultiplied
+        self.nbytes = inv_alpha.nbytes + premultiplied.nbytes
+
+def rasterize_sprite(draw, width, height, origin=(0, 0)):
+    """Rasterise draw(canvas) once into a Sprite, or None if it draws nothing
+
+    The drawing is done on a black and on a white canvas. Every OpenCV draw
+    call maps a background pixel b to b * (1 - c) + colour * c, so the two
+    results give coverage and colour exactly, anti-aliasing included. The
+    sprite is cropped to the covered pixels and positioned relative to origin.
+    """
+    black = np.zeros((height, width, 3), np.uint8)
+    white = np.full((height, width, 3), 255, np.uint8)
+    draw(black)
+    draw(white)
+
+    inv_alpha = np.clip(white.astype(np.int16) - black, 0, 255).astype(np.uint16)
+    ys, xs = np.nonzero((inv_alpha != 255).any(axis=2))
+    if len(xs) == 0:
+        return None
+
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    return Sprite(
+        int(x0) - origin[0],
+        int(y0) - origin[1],
+        np.ascontiguousarray(inv_alpha[y0:y1, x0:x1]),
+        black[y0:y1, x0:x1].astype(np.uint16) * 255
+    )
+
+def blend_sprite(frame, sprite, x=0, y=0):
+    """Blend a sprite onto frame with its origin at (x, y), clipped to the frame"""
+    h, w = sprite.inv_alpha.shape[:2]
+    left, top = x + sprite.x, y + sprite.y
+    x0, y0 = max(left, 0), max(top, 0)
+    x1, y1 = min(left + w, frame.shape[1]), min(top + h, frame.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    sx, sy = x0 - left, y0 - top
+    inv_alpha = sprite.inv_alpha[sy:sy + y1 - y0, sx:sx + x1 - x0]
+    premultiplied = sprite.premultiplied[sy:sy + y1 - y0, sx:sx + x1 - x0]
+    roi = frame[y0:y1, x0:x1]
+    roi[:] = (roi * inv_alpha + premultiplied + 127) // 255
+
+class SpriteCache:
+    """LRU cache of rasterised overlays, bounded by total bytes"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.sprites = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        if key in self.sprites:
+            self.sprites.move_to_end(key)
+            self.hits += 1
+            return self.sprites[key]
+
+        self.misses += 1
+        sprite = render()
+        self.sprites[key] = sprite
+        self.nbytes += sprite.nbytes if sprite is not None else 0
+        while self.nbytes > self.max_bytes and len(self.sprites) > 1:
+            _, evicted = self.sprites.popitem(last=False)
+            self.nbytes -= evicted.nbytes if evicted is not None else 0
+        return sprite
 
-            if results.pose_landmarks:
-                head = results.pose_landmarks.landmark[0]
-                head_x = int(head.x * width)
-                head_y = int(head.y * height)
-                last_head = (head_x, head_y)
+class OverlayRenderer:
+    """Draws the marker, stats and feedback overlays onto frames, in order
 
+    Animation timing is measured in video frames rather than wall-clock time
+    so the output does not depend on how fast frames are processed.
+    """
+
+    # The marker is rasterised around a fixed anchor so one sprite serves every head position
+    MARKER_CANVAS = (300, 120)
+    MARKER_ANCHOR = (150, 80)
+
+    def __init__(self, events, sport_type, fps, width, height, animation_duration=1.25,
+                 sprite_cache_bytes=64 * 1024 * 1024):
+        self.timeline = EventTimeline(events)
+        self.sprites = SpriteCache(sprite_cache_bytes) if sprite_cache_bytes else None
+        self.sport_type = sport_type
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.animation_duration = animation_duration
+        self.last_event_frame = None
+        self.last_event_result = None
+        self.current_color = (255, 255, 255)
+        self.drawn_until = 0
+
+    def seek(self, frame_count):
+        """Restore animation state as if every frame before frame_count had been drawn"""
+        self.last_event_frame = None
+        self.last_event_result = None
+        self.current_color = (255, 255, 255)
+        self.drawn_until = frame_count - 1
+        event = self.timeline.last_fired(frame_count - 1)
+        if event is not None and event['frame_number'] >= 1:
+            self.last_event_frame = event['frame_number']
+            self.last_event_result = event['result']
+
+    def draw(self, frame, frame_count, head):
         # Draw player indicator
-        if last_head is not None:
-            head_x, head_y = last_head
-            arrow_height = 30
-            arrow_width = 45
-            arrow_tip_y = max(0, head_y - 110)
-            pt1 = (head_x, arrow_tip_y + arrow_height)
-            pt2 = (head_x - arrow_width // 2, arrow_tip_y)
-            pt3 = (head_x + arrow_width // 2, arrow_tip_y)
-            pts = np.array([pt1, pt2, pt3], np.int32).reshape((-1, 1, 2))
-            cv2.fillPoly(frame, [pts], (0, 0, 255))
-
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            text = "Player"
-            text_size = cv2.getTextSize(text, font, 0.8, 2)[0]
-            text_x = head_x - text_size[0] // 2
-            text_y = arrow_tip_y - 10
-            cv2.putText(frame, text, (text_x, text_y), font, 0.8, (0, 0, 0), 6, cv2.LINE_AA)
-            cv2.putText(frame, text, (text_x, text_y), font, 0.8, (255, 255, 255), 2, cv2.LINE_AA)
+        if head is not None:
+            self._draw_marker(frame, head)
 
         # Update stats and feedback - only show feedback for the most recent active event
         current_stats = {}
         current_feedback = None
-        active_event = None
-
-        for event in events:
-            if event['frame_number'] <= frame_count:
-                if event['frame_number'] == frame_count:
-                    last_event_time = time.time()
-                    last_event_result = event['result']
 
-                if sport_type == "basketball":
-                    current_stats = {
-                        'made': event.get('made_count', 0),
-                        'missed': event.get('missed_count', 0)
-                    }
+        last_event = self.timeline.last_fired(frame_count)
+        if last_event is not None:
+            # Previews skip frames, so an event may have fired on a frame that was never drawn
+            if last_event['frame_number'] > self.drawn_until:
+                self.last_event_frame = last_event['frame_number']
+                self.last_event_result = last_event['result']
 
-                # Only keep the most recent active feedback
-                if event['frame_number'] <= frame_count <= event['feedback_end_frame']:
-                    active_event = event
+            if self.sport_type == "basketball":
+                current_stats = {
+                    'made': last_event.get('made_count', 0),
+                    'missed': last_event.get('missed_count', 0)
+                }
 
         # Set current feedback only from the most recent active event
+        active_event = self.timeline.active(frame_count)
         if active_event:
             current_feedback = active_event['feedback']
 
         # Calculate animation color
-        if last_event_time is not None:
-            elapsed_time = time.time() - last_event_time
-            if elapsed_time < animation_duration:
-                is_success = last_event_result in ['made', 'success']
-                current_color = get_animation_color(elapsed_time, animation_duration, is_success)
+        if self.last_event_frame is not None:
+            elapsed_time = (frame_count - self.last_event_frame) / self.fps
+            if elapsed_time < self.animation_duration:
+                is_success = self.last_event_result in ['made', 'success']
+                self.current_color = get_animation_color(elapsed_time, self.animation_duration, is_success)
             else:
-                current_color = (255, 255, 255)
-                last_event_time = None
+                self.current_color = (255, 255, 255)
+                self.last_event_frame = None
 
         # Draw statistics (basketball specific)
-        if sport_type == "basketball" and current_stats:
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            scale = 0.8
-            thickness = 2
-            border_thickness = 4
-            spacing = 35
-            x = 20
-            y = 40
-
-            made = current_stats.get('made', 0)
-            missed = current_stats.get('missed', 0)
-
-            made_text = f"Shots Made: {made}"
-            cv2.putText(frame, made_text, (x, y), font, scale, (0, 0, 0), border_thickness, cv2.LINE_AA)
-            made_color = current_color if last_event_result == 'made' else (255, 255, 255)
-            cv2.putText(frame, made_text, (x, y), font, scale, made_color, thickness, cv2.LINE_AA)
-
-            missed_text = f"Shots Missed: {missed}"
-            cv2.putText(frame, missed_text, (x, y + spacing), font, scale, (0, 0, 0), border_thickness, cv2.LINE_AA)
-            missed_color = current_color if last_event_result == 'missed' else (255, 255, 255)
-            cv2.putText(frame, missed_text, (x, y + spacing), font, scale, missed_color, thickness, cv2.LINE_AA)
+        if self.sport_type == "basketball" and current_stats:
+            self._draw_stats(frame, current_stats)
 
         # Draw feedback - only show current feedback, clearing previous ones
         if current_feedback:
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            scale = 0.6
-            thickness = 1
-            border_thickness = 3
-            max_width = int(width * 0.9)
-            wrapped_lines = wrap_text(current_feedback, font, scale, thickness, max_width)
-            feedback_text = current_feedback
-            text_size = cv2.getTextSize(feedback_text, font, scale, thickness)[0]
-
-            if text_size[0] > max_width:
-                # Calculate total height needed for all lines
-                line_height = 25
-                total_height = len(wrapped_lines) * line_height
-                feedback_y = height - 60 - total_height + line_height
-
-                for line in wrapped_lines:
-                    text_size = cv2.getTextSize(line, font, scale, thickness)[0]
-                    feedback_x = (width - text_size[0]) // 2
-                    cv2.putText(frame, line, (feedback_x, feedback_y), font, scale, (0, 0, 0), border_thickness, cv2.LINE_AA)
-                    cv2.putText(frame, line, (feedback_x, feedback_y), font, scale, (255, 255, 255), thickness, cv2.LINE_AA)
-                    feedback_y += line_height
-            else:
-                feedback_x = (width - text_size[0]) // 2
-                feedback_y = height - 60
-                cv2.putText(frame, feedback_text, (feedback_x, feedback_y), font, scale, (0, 0, 0), border_thickness, cv2.LINE_AA)
-                cv2.putText(frame, feedback_text, (feedback_x, feedback_y), font, scale, (255, 255, 255), thickness, cv2.LINE_AA)
+            self._draw_feedback(frame, current_feedback)
 
-        processed_frames.append(frame.copy())
+        self.drawn_until = frame_count
+        return frame
 
-    cap.release()
-    pose.close()
-    cv2.destroyAllWindows()
+    def _draw_marker(self, frame, head):
+        if self.sprites is None:
+            draw_player_marker(frame, head)
+            return
 
-    # Write output video
-    print("Creating final video...")
-    codecs_to_try = ['avc1', 'mp4v', 'XVID']
+        anchor_x, anchor_y = self.MARKER_ANCHOR
+        sprite = self.sprites.get(('marker',), lambda: rasterize_sprite(
+            lambda canvas: draw_player_marker(canvas, (anchor_x, anchor_y + 110)),
+            *self.MARKER_CANVAS, origin=self.MARKER_ANCHOR))
+        if sprite is not None:
+            head_x, head_y = head
+            blend_sprite(frame, sprite, head_x, max(0, head_y - 110))
 
-    out = None
-    for codec in codecs_to_try:
-        fourcc = cv2.VideoWriter_fourcc(*codec)
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-        if out.isOpened():
-            print(f"Using codec: {codec}")
+    def _draw_stats(self, frame, current_stats):
+        if self.sprites is None:
+            draw_basketball_stats(frame, current_stats, self.current_color, self.last_event_result)
+            return
+
+        made_color = self.current_color if self.last_event_result == 'made' else (255, 255, 255)
+        missed_color = self.current_color if self.last_event_result == 'missed' else (255, 255, 255)
+        key = ('stats', current_stats.get('made', 0), current_stats.get('missed', 0), made_color, missed_color)
+        sprite = self.sprites.get(key, lambda: self._rasterize_stats(current_stats))
+        if sprite is not None:
+            blend_sprite(frame, sprite)
+
+    def _rasterize_stats(self, current_stats):
+        # The HUD sits at a fixed spot in the top-left corner, so only that corner is rasterised
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        texts = [f"Shots Made: {current_stats.get('made', 0)}", f"Shots Missed: {current_stats.get('missed', 0)}"]
+        text_width = max(cv2.getTextSize(text, font, 0.8, 4)[0][0] for text in texts)
+        return rasterize_sprite(
+            lambda canvas: draw_basketball_stats(canvas, current_stats, self.current_color, self.last_event_result),
+            min(self.width, 20 + text_width + 20), min(self.height, 40 + 35 + 30))
+
+    def _draw_feedback(self, frame, feedback):
+        if self.sprites is None:
+            draw_feedback(frame, feedback, self.width, self.height)
+            return
+
+        sprite = self.sprites.get(('feedback', feedback), lambda: self._rasterize_feedback(feedback))
+        if sprite is not None:
+            blend_sprite(frame, sprite)
+
+    def _rasterize_feedback(self, feedback):
+        # Feedback is anchored to the bottom of the frame, so only a band tall
+        # enough for the wrapped lines is rasterised and then shifted down
+        lines = wrap_text(feedback, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1, int(self.width * 0.9))
+        band_height = min(self.height, 60 + 25 * max(1, len(lines)) + 30)
+        return rasterize_sprite(
+            lambda canvas: draw_feedback(canvas, feedback, self.width, band_height),
+            self.width, band_height, origin=(0, band_height - self.height))
+
+class StageStats:
+    """Frame count and busy time for one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.0
+
+    def as_dict(self, wall_time):
+        return {
+            'frames': self.frames,
+            'busy_seconds': round(self.busy, 3),
+            'fps': round(self.frames / self.busy, 1) if self.busy > 0 else None,
+            'utilization': round(self.busy / wall_time, 3) if wall_time > 0 else None
+        }
+
+def print_pose_report(pose_sampling, pose_calls, fixed_calls):
+    saved = fixed_calls - pose_calls
+    percent = 100 * saved / fixed_calls if fixed_calls else 0
+    print(f"Pose calls: {pose_calls} ({pose_sampling}), fixed stride would use {fixed_calls} "
+          f"({saved} saved, {percent:.0f}%)")
+
+def print_stage_report(stage_stats):
+    print("Stage throughput:")
+    for name, stats in stage_stats.items():
+        fps = f"{stats['fps']:.1f} fps" if stats['fps'] else "n/a"
+        utilization = f"{stats['utilization'] * 100:.0f}%" if stats['utilization'] is not None else "n/a"
+        print(f"  {name:<8} {stats['frames']:>7} frames  {stats['busy_seconds']:>8.2f}s busy  {fps:>12}  {utilization:>5} of wall time")
+
+_STOP = object()
+
+def _queue_put(q, item, abort):
+    while not abort.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _queue_get(q, abort):
+    while not abort.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _STOP
+
+def run_sequential(cap, tracker, renderer, write_frame, first_frame=1, last_frame=None):
+    """Decode, detect, draw and encode one frame at a time on this thread
+
+    Frames are numbered from 1. cap must already be positioned at first_frame;
+    decoding stops after last_frame (or at the end of the video).
+    """
+    stats = {name: StageStats(name) for name in ('decode', 'pose', 'overlay', 'encode')}
+    frame_count = first_frame - 1
+
+    while cap.isOpened() and (last_frame is None or frame_count < last_frame):
+        start = time.perf_counter()
+        ret, frame = cap.read()
+        if not ret:
             break
+        stats['decode'].busy += time.perf_counter() - start
+        stats['decode'].frames += 1
+
+        frame_count += 1
+
+        # Process pose detection
+        start = time.perf_counter()
+        head = tracker.update(frame_count, frame)
+        stats['pose'].busy += time.perf_counter() - start
+        stats['pose'].frames += 1
+
+        start = time.perf_counter()
+        renderer.draw(frame, frame_count, head)
+        stats['overlay'].busy += time.perf_counter() - start
+        stats['overlay'].frames += 1
+
+        start = time.perf_counter()
+        write_frame(frame)
+        stats['encode'].busy += time.perf_counter() - start
+        stats['encode'].frames += 1
+
+    return stats
+
+def run_pipelined(cap, tracker, renderer, write_frame, first_frame=1, last_frame=None, queue_size=8):
+    """Run decode -> pose -> overlay -> encode as threads joined by bounded queues
+
+    Each stage has a single worker so frame order is preserved, and the queues
+    cap the number of frames in flight at roughly 3 * queue_size.
+    """
+    stats = {name: StageStats(name) for name in ('decode', 'pose', 'overlay', 'encode')}
+    decoded = queue.Queue(maxsize=queue_size)
+    posed = queue.Queue(maxsize=queue_size)
+    drawn = queue.Queue(maxsize=queue_size)
+    abort = threading.Event()
+    errors = []
+
+    def decode_stage():
+        frame_count = first_frame - 1
+        while cap.isOpened() and (last_frame is None or frame_count < last_frame):
+            start = time.perf_counter()
+            ret, frame = cap.read()
+            if not ret:
+                break
+            stats['decode'].busy += time.perf_counter() - start
+            stats['decode'].frames += 1
+            frame_count += 1
+            if not _queue_put(decoded, (frame_count, frame), abort):
+                return
+        _queue_put(decoded, _STOP, abort)
+
+    def pose_stage():
+        while True:
+            item = _queue_get(decoded, abort)
+            if item is _STOP:
+                break
+            frame_count, frame = item
+            start = time.perf_counter()
+            head = tracker.update(frame_count, frame)
+            stats['pose'].busy += time.perf_counter() - start
+            stats['pose'].frames += 1
+            if not _queue_put(posed, (frame_count, frame, head), abort):
+                return
+        _queue_put(posed, _STOP, abort)
+
+    def overlay_stage():
+        while True:
+            item = _queue_get(posed, abort)
+            if item is _STOP:
+                break
+            frame_count, frame, head = item
+            start = time.perf_counter()
+            renderer.draw(frame, frame_count, head)
+            stats['overlay'].busy += time.perf_counter() - start
+            stats['overlay'].frames += 1
+            if not _queue_put(drawn, frame, abort):
+                return
+        _queue_put(drawn, _STOP, abort)
+
+    def encode_stage():
+        while True:
+            frame = _queue_get(drawn, abort)
+            if frame is _STOP:
+                break
+            start = time.perf_counter()
+            write_frame(frame)
+            stats['encode'].busy += time.perf_counter() - start
+            stats['encode'].frames += 1
+
+    def run_stage(target):
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+            abort.set()
+
+    threads = [
+        threading.Thread(target=run_stage, args=(stage,), name=f"annotate-{stage.__name__}", daemon=True)
+        for stage in (decode_stage, pose_stage, overlay_stage, encode_stage)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return stats
+
+def split_frame_ranges(total_frames, segments, min_segment_frames=1):
+    """Split frames 1..total_frames into contiguous (first, last) ranges
+
+    The last range is open-ended (last=None) because CAP_PROP_FRAME_COUNT is
+    only an estimate for some containers.
+    """
+    segments = max(1, min(segments, total_frames // max(1, min_segment_frames)))
+    bounds = [1 + (total_frames * i) // segments for i in range(segments + 1)]
+    ranges = [(bounds[i], bounds[i + 1] - 1) for i in range(segments)]
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+def render_segment(video_path, segment_path, first_frame, last_frame, events, sport_type,
+                   preroll_frames, pipelined=False, queue_size=8, pose_options=None,
+                   pose_track_path=None, record_track=False, encoder='auto', encoder_options=None):
+    """Annotate frames first_frame..last_frame of a video into their own file
+
+    Runs in a worker process with its own Pose instance. Pose tracking is
+    warmed up on up to preroll_frames frames before the segment so the marker
+    does not jump at the boundary, and the overlay animation state is restored
+    from the events that fired earlier in the video. With pose_track_path set
+    the saved track is replayed instead and no Pose is created.
+
+    Returns the stage stats, the pose calls made, the fixed-stride count and,
+    with record_track, the head track of the segment's frames.
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    tracker, pose = open_head_tracker(fps, width, height, events, pose_options, pose_track_path)
+
+    # A replayed track needs no warm-up
+    preroll_start = max(1, first_frame - preroll_frames) if pose is not None else first_frame
+    cap.set(cv2.CAP_PROP_POS_FRAMES, preroll_start - 1)
+    if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != preroll_start - 1:
+        print(f"Warning: inexact seek to frame {preroll_start} in {video_path}")
+
+    for frame_count in range(preroll_start, first_frame):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        tracker.update(frame_count, frame)
+    if record_track and pose is not None:
+        tracker.track = []
+
+    renderer = OverlayRenderer(events, sport_type, fps, width, height)
+    renderer.seek(first_frame)
+
+    out, _ = open_frame_writer(segment_path, fps, width, height, encoder, encoder_options)
+    run = run_pipelined if pipelined else run_sequential
+    run_kwargs = {'queue_size': queue_size} if pipelined else {}
+    try:
+        stats = run(cap, tracker, renderer, out.write, first_frame=first_frame, last_frame=last_frame, **run_kwargs)
+        track = tracker.track if record_track and pose is not None else None
+        return stats, tracker.calls, tracker.fixed_calls, track
+    finally:
+        cap.release()
         out.release()
 
-    if out is None or not out.isOpened():
-        raise RuntimeError("Failed to initialize video writer with any codec")
+def concat_segments(segment_paths, output_path, fps, width, height):
+    """Join segment files into one video with ffmpeg's concat demuxer (no re-encode)
 
-    for frame in processed_frames:
-        out.write(frame)
+    Falls back to decoding and re-encoding the segments with OpenCV when
+    ffmpeg is unavailable.
+    """
+    list_path = output_path + '.segments.txt'
+    with open(list_path, 'w') as f:
+        for segment_path in segment_paths:
+            f.write(f"file '{os.path.abspath(segment_path)}'\n")
 
+    cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', '-y', output_path]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+        return
+    except subprocess.CalledProcessError as e:
+        print(f"Warning: Could not concatenate segments losslessly: {e}")
+        print(f"Error output: {e.stderr.decode()}")
+    except FileNotFoundError:
+        print("Warning: ffmpeg not found. Re-encoding segments with OpenCV.")
+    finally:
+        os.remove(list_path)
+
+    out = open_video_writer(output_path, fps, width, height)
+    for segment_path in segment_paths:
+        cap = cv2.VideoCapture(segment_path)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            out.write(frame)
+        cap.release()
     out.release()
 
-    # Add audio to video using ffmpeg
-    if audio_files:
-        print("Adding audio to video...")
-        temp_video_path = output_path.replace('.mp4', '_temp.mp4')
-        os.rename(output_path, temp_video_path)
-
-        # Create filter complex for audio
-        filter_parts = []
-        audio_inputs = []
-
-        for i, (frame_num, audio_path) in enumerate(audio_files):
-            timestamp_seconds = frame_num / fps
-            audio_inputs.extend(['-i', audio_path])
-            filter_parts.append(f"[{i+1}:a]adelay={int(timestamp_seconds * 1000)}|{int(timestamp_seconds * 1000)}[a{i}]")
-
-        if filter_parts:
-            filter_complex = ';'.join(filter_parts)
-            mix_inputs = ''.join([f"[a{i}]" for i in range(len(audio_files))])
-            filter_complex += f";{mix_inputs}amix=inputs={len(audio_files)}:duration=longest[aout]"
-
-            import subprocess
-            cmd = ['ffmpeg', '-i', temp_video_path] + audio_inputs + [
-                '-filter_complex', filter_complex,
-                '-map', '0:v',
-                '-map', '[aout]',
-                '-c:v', 'copy',
-                '-c:a', 'aac',
-                '-shortest',
-                '-y',
-                output_path
-            ]
-
-            try:
-                subprocess.run(cmd, check=True, capture_output=True)
-                os.remove(temp_video_path)
-                print("Audio integrated successfully!")
-            except subprocess.CalledProcessError as e:
-                print(f"Warning: Could not add audio to video: {e}")
-                print(f"Error output: {e.stderr.decode()}")
-                os.rename(temp_video_path, output_path)
-            except FileNotFoundError:
-                print("Warning: ffmpeg not found. Video saved without audio.")
-                os.rename(temp_video_path, output_path)
-
-    # Cleanup temporary audio files
-    import shutil
-    shutil.rmtree(temp_dir, ignore_errors=True)
-
-    print(f"Annotated video saved to: {output_path}")
+def annotate_segments(video_path, output_path, events, sport_type, fps, width, height, total_frames,
+                      segments, temp_dir, pose_options, preroll_seconds=1.0, pipelined=False, queue_size=8,
+                      pose_track_path=None, record_track=False, encoder='auto', encoder_options=None):
+    """Annotate frame ranges in parallel worker processes, then join the results
 
-if __name__ == "__main__":
-    import sys
-    import json
+    Workers are spawned rather than forked: the caller may be running
+    SpeechJobs threads and holding a MediaPipe graph, neither of which
+    survives a fork.
+
+    x264's threads (encoder_options['threads'], or every core when that is
+    0) are divided between the workers, as batch.run_batch does for its
+    renders, so the segments don't oversubscribe the CPU.
+
+    Returns the summed stage stats, pose calls and fixed-stride pose calls,
+    and the joined head track when record_track is set.
+    """
+    ranges = split_frame_ranges(total_frames, segments, min_segment_frames=2 * fps)
+    encoder_options = dict(encoder_options or {})
+    threads = encoder_options.get('threads') or os.cpu_count() or 1
+    encoder_options['threads'] = max(1, threads // len(ranges))
+    segment_paths = [os.path.join(temp_dir, f"segment_{i:04d}.mp4") for i in range(len(ranges))]
+    preroll_frames = int(preroll_seconds * fps)
+
+    print(f"Rendering {len(ranges)} segments in parallel")
+    totals = {name: StageStats(name) for name in ('decode', 'pose', 'overlay', 'encode')}
+    pose_calls = fixed_calls = 0
+    track = [] if record_track else None
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(render_segment, video_path, segment_path, first_frame, last_frame, events,
+                            sport_type, preroll_frames, pipelined, queue_size, pose_options,
+                            pose_track_path, record_track, encoder, encoder_options)
+            for segment_path, (first_frame, last_frame) in zip(segment_paths, ranges)
+        ]
+        for future in futures:
+            segment_stats, segment_calls, segment_fixed_calls, segment_track = future.result()
+            if track is not None:
+                track.extend(segment_track)
+            for name, stats in segment_stats.items():
+                totals[name].frames += stats.frames
+                totals[name].busy += stats.busy
+            pose_calls += segment_calls
+            fixed_calls += segment_fixed_calls
+
+    concat_segments(segment_paths, output_path, fps, width, height)
+    return totals, pose_calls, fixed_calls, track
+
+def report_progress(write_frame, progress, total_frames, every):
+    """Wrap write_frame so progress(frames_written, total_frames) is called every `every` frames"""
+    frames_written = 0
+
+    def write(frame):
+        nonlocal frames_written
+        write_frame(frame)
+        frames_written += 1
+        if frames_written % every == 0:
+            progress(frames_written, total_frames)
+    return write
+
+def mux_feedback_audio(output_path, audio_track):
+    """Add the mixed feedback track to a rendered video without re-encoding the video"""
+    print("Adding audio to video...")
+    temp_video_path = output_path.replace('.mp4', '_temp.mp4')
+    os.rename(output_path, temp_video_path)
+
+    cmd = ['ffmpeg', '-i', temp_video_path, '-i', audio_track,
+        '-map', '0:v',
+        '-map', '1:a',
+        '-c:v', 'copy',
+        '-c:a', 'aac',
+        '-shortest',
+        '-y',
+        output_path
+    ]
+
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+        os.remove(temp_video_path)
+        print("Audio integrated successfully!")
+    except subprocess.CalledProcessError as e:
+        print(f"Warning: Could not add audio to video: {e}")
+        print(f"Error output: {e.stderr.decode()}")
+        os.rename(temp_video_path, output_path)
+    except FileNotFoundError:
+        print("Warning: ffmpeg not found. Video saved without audio.")
+        os.rename(temp_video_path, output_path)
+
+def annotate_video(video_path, analysis_data, output_path, sport_type, streaming=True,
+                   pipelined=False, queue_size=8, segments=1, pose_sampling='fixed', pose_budget=0.5,
+                   pose_resolution=None, pose_cache='auto', video_hash=None, encoder='auto',
+                   x264_preset='veryfast', encoder_threads=0, tts_workers=4, tts_overlap=False, progress=None,
+                   progressive_dir=None):
+    """Annotate video with analysis data based on sport type
+
+    With streaming=True (default) the writer is opened up front and each frame
+    is written as soon as its overlays are drawn, so memory stays flat however
+    long the video is. streaming=False keeps the old behaviour of buffering all
+    frames and writing them once decoding is done.
+
+    With pipelined=True decode, pose detection, overlay drawing and encoding
+    each run on their own thread, connected by queues of queue_size frames.
+
+    With segments > 1 the video is split into that many frame ranges, each
+    annotated in its own process, and the pieces are joined without
+    re-encoding. Segment rendering always streams.
+
+    pose_sampling='adaptive' runs MediaPipe densely only around events and
+    motion, within pose_budget (a fraction of the fixed-stride pose calls),
+    and interpolates the marker in between. See HeadTracker.
+
+    pose_resolution limits the longer side of the frames given to MediaPipe
+    (e.g. 640). Overlays are still drawn on the full-resolution frame.
+
+    The per-frame head track is saved under POSE_CACHE_DIR, keyed by the
+    video's content hash (video_hash, if already known) and the pose
+    settings, and later runs replay it without MediaPipe. pose_cache is
+    'auto' (use or create), 'refresh' (recompute and overwrite), 'only'
+    (fail if there is no saved track) or 'off'.
+
+    encoder='ffmpeg' pipes frames into one long-lived ffmpeg process that
+    encodes with x264 (x264_preset, encoder_threads; 0 lets x264 decide, or
+    splits the cores between segments) and mixes in the feedback audio, so
+    the final file is written in one pass. encoder='opencv' uses cv2.VideoWriter and a second ffmpeg pass for the
+    audio; 'auto' picks ffmpeg when it is on PATH.
+
+    Feedback speech is synthesised tts_workers clips at a time while the
+    video is opened and MediaPipe loaded, and waited for before the first
+    frame is encoded, so the ffmpeg encoder can mux it in the same pass.
+    Clips already in the speech cache (jobs and batches prefetch them) make
+    the wait free. tts_overlap=True keeps synthesising while the frames
+    render instead; unless every clip was cached, that costs a second
+    ffmpeg pass, which copies the finished video into a new file with the
+    audio. Segmented renders always add the audio in that second pass.
+
+    progress, if given, is called as progress(frames_done, total_frames)
+    about once a second of video while rendering, and once at the end.
+    Segmented renders only report at the end.
+
+    With progressive_dir set, frames are encoded into an HLS playlist of
+    fragmented-MP4 segments there (see HLSWriter), which players can start
+    on while the render is still running. output_path is then remuxed from
+    the playlist at the end. Needs ffmpeg, streaming and a single segment.
+    The feedback speech is always waited for before encoding starts (even
+    with tts_overlap), so the live segments carry it. Only when the
+    container doesn't report a frame count is the stream video-only, with
+    the audio added to output_path alone.
+
+    Returns per-stage throughput stats.
+    """
+    if progressive_dir is not None:
+        if segments > 1 or not streaming or encoder == 'opencv':
+            raise ValueError("Progressive output needs a single streaming ffmpeg render")
+        if not ffmpeg_available():
+            raise RuntimeError("Progressive output needs ffmpeg on PATH")
+
+    cap = cv2.VideoCapture(video_path)
+    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    encoder_options = {'preset': x264_preset, 'threads': encoder_threads}
+    pose_options = {
+        'pose_sampling': pose_sampling,
+        'pose_budget': pose_budget,
+        'pose_resolution': pose_resolution
+    }
+
+    try:
+        track_path, saved_track = resolve_pose_track(video_path, fps, pose_options, pose_cache, video_hash)
+    except FileNotFoundError:
+        cap.release()
+        raise
+    record_track = track_path is not None and saved_track is None
 
-    if len(sys.argv) < 4:
-        print("Usage: python ball.py <video_path> <sports_json> <output_path> <sport_type>")
-        print("Example: python ball.py final_ball.mp4 sports.json final.mp4 basketball")
-        sys.exit(1)
+    # Temporary directory for audio files and segments
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # Prepare events based on sport type
+        events, speech = build_events(analysis_data, sport_type, fps)
+        speech_jobs = SpeechJobs(speech, temp_dir, tts_workers)
+        # A live stream can't be remuxed with audio later, so progressive renders always wait
+        wait_for_speech = not tts_overlap or speech_jobs.cached or progressive_dir is not None
+        audio_files = None
+
+        print(f"Processing video: {video_path}")
+        print(f"Total events to annotate: {len(events)}")
+
+        wall_start = time.perf_counter()
+        try:
+            if segments > 1:
+                cap.release()
+                stage_stats, pose_calls, fixed_calls, track = annotate_segments(
+                    video_path, output_path, events, sport_type, fps, width, height, total_frames, segments, temp_dir,
+                    pose_options, pipelined=pipelined, queue_size=queue_size,
+                    pose_track_path=saved_track, record_track=record_track, encoder=encoder, encoder_options=encoder_options)
+                audio_muxed = False
+            else:
+                tracker, pose = open_head_tracker(fps, width, height, events, pose_options, saved_track, record_track)
+                renderer = OverlayRenderer(events, sport_type, fps, width, height)
+                if wait_for_speech:
+                    audio_files = speech_jobs.result()
+
+                # Only the ffmpeg writer can take the audio track while encoding
+                mux_while_encoding = bool(audio_files) and encoder != 'opencv' and ffmpeg_available()
+                out, audio_muxed = None, False
+                if streaming:
+                    # Muxing audio while encoding needs the video length up front; if the
+                    # container doesn't report it, the audio is muxed afterwards instead
+                    audio_track = None
+                    if mux_while_encoding and total_frames > 0:
+                        audio_track = build_audio_track(audio_files, fps, total_frames / fps, temp_dir)
+                    if progressive_dir is not None:
+                        out = HLSWriter(progressive_dir, fps, width, height, audio_track, **encoder_options)
+                        audio_muxed = bool(audio_track)
+                        print(f"Streaming HLS segments to: {progressive_dir}")
+                    else:
+                        out, audio_muxed = open_frame_writer(output_path, fps, width, height, encoder, encoder_options,
+                                                             audio_track)
+                processed_frames = []
+                write_frame = out.write if streaming else processed_frames.append
+                if progress is not None:
+                    write_frame = report_progress(write_frame, progress, total_frames, max(1, fps))
+                run = run_pipelined if pipelined else run_sequential
+                run_kwargs = {'queue_size': queue_size} if pipelined else {}
+
+                try:
+                    stage_stats = run(cap, tracker, renderer, write_frame, **run_kwargs)
+                finally:
+                    cap.release()
+                    cv2.destroyAllWindows()
+                    if out is not None:
+                        out.release()
+
+                if not streaming:
+                    # Write output video
+                    print("Creating final video...")
+                    audio_track = None
+                    if mux_while_encoding:
+                        audio_track = build_audio_track(audio_files, fps, len(processed_frames) / fps, temp_dir)
+                    out, audio_muxed = open_frame_writer(output_path, fps, width, height, encoder, encoder_options, audio_track)
+                    for frame in processed_frames:
+                        out.write(frame)
+                    out.release()
+                pose_calls, fixed_calls = tracker.calls, tracker.fixed_calls
+                track = tracker.track if record_track else None
+        except BaseException:
+            speech_jobs.cancel()
+            raise
+        wall_time = time.perf_counter() - wall_start
+
+        stage_stats = {name: stats.as_dict(wall_time) for name, stats in stage_stats.items()}
+        print_stage_report(stage_stats)
+        print_pose_report(pose_sampling, pose_calls, fixed_calls)
+
+        if record_track:
+            save_pose_track(track_path, track)
+            print(f"Pose track saved to: {track_path}")
+
+        # Add audio to video using ffmpeg, unless the encoder already muxed it
+        if audio_files is None:
+            audio_files = speech_jobs.result()
+        audio_track = None
+        if audio_files and not audio_muxed:
+            audio_track = build_audio_track(audio_files, fps, stage_stats['encode']['frames'] / fps, temp_dir)
+        if progressive_dir is not None:
+            remux_progressive(os.path.join(progressive_dir, HLSWriter.PLAYLIST), output_path, audio_track)
+        elif audio_track:
+            mux_feedback_audio(output_path, audio_track)
+
+        print(f"Annotated video saved to: {output_path}")
+        if progress is not None:
+            progress(stage_stats['decode']['frames'], total_frames)
+        return {
+            'frames': stage_stats['decode']['frames'],
+            'wall_seconds': round(wall_time, 3),
+            'stages': stage_stats,
+            'pose_calls': pose_calls,
+            'pose_calls_fixed_stride': fixed_calls
+        }
+    finally:
+        # Segment files can run to gigabytes, so they go whether or not the render succeeded
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def preview_size(width, height, max_height):
+    """Frame size scaled down to fit max_height, with even sides for yuv420p"""
+    if height > max_height:
+        width, height = width * max_height / height, max_height
+    return max(2, int(round(width / 2)) * 2), max(2, int(round(height / 2)) * 2)
+
+def annotate_preview(video_path, analysis_data, output_path, sport_type, preview_height=PREVIEW_HEIGHT,
+                     preview_fps=PREVIEW_FPS, pose_sampling='fixed', pose_budget=0.5, pose_resolution=None,
+                     pose_cache='auto', video_hash=None, progress=None):
+    """Render a small, silent preview of the annotated video, fast
+
+    Frames are dropped to preview_fps, drawn at full size and then scaled
+    down to preview_height, and encoded with x264's ultrafast preset. No
+    feedback audio is made.
+
+    Pose tracking still sees every frame, and the head track goes to the
+    same POSE_CACHE_DIR entry annotate_video uses, so a full render with
+    the same pose settings afterwards replays this track rather than
+    running MediaPipe again (not with pose_cache='off'). With a saved
+    track, dropped frames aren't decoded at all.
+
+    progress is called as in annotate_video, in source frames.
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    pose_options = {
+        'pose_sampling': pose_sampling,
+        'pose_budget': pose_budget,
+        'pose_resolution': pose_resolution
+    }
+    try:
+        track_path, saved_track = resolve_pose_track(video_path, fps, pose_options, pose_cache, video_hash)
+    except FileNotFoundError:
+        cap.release()
+        raise
+    record_track = track_path is not None and saved_track is None
+
+    events, _ = build_events(analysis_data, sport_type, fps)
+    tracker, pose = open_head_tracker(fps, width, height, events, pose_options, saved_track, record_track)
+    renderer = OverlayRenderer(events, sport_type, fps, width, height)
+
+    out_fps = min(preview_fps, fps)
+    size = preview_size(width, height, preview_height)
+    out, _ = open_frame_writer(output_path, out_fps, *size, encoder_options={'preset': 'ultrafast'})
+    print(f"Rendering preview: {size[0]}x{size[1]} @ {out_fps:g} fps")
+
+    wall_start = time.perf_counter()
+    frame_count = frames_written = 0
+    try:
+        while cap.isOpened():
+            frame_count += 1
+            keep = int(frame_count * out_fps / fps) > int((frame_count - 1) * out_fps / fps)
+            if keep or pose is not None:
+                ret, frame = cap.read()
+            else:
+                ret, frame = cap.grab(), None
+            if not ret:
+                frame_count -= 1
+                break
+
+            head = tracker.update(frame_count, frame)
+            if not keep:
+                continue
+            renderer.draw(frame, frame_count, head)
+            if size != (width, height):
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            out.write(frame)
+            frames_written += 1
+            if progress is not None and frames_written % max(1, int(out_fps)) == 0:
+                progress(frame_count, total_frames)
+    finally:
+        cap.release()
+        out.release()
+    wall_time = time.perf_counter() - wall_start
+
+    print_pose_report(pose_sampling, tracker.calls, tracker.fixed_calls)
+    if record_track:
+        save_pose_track(track_path, tracker.track)
+        print(f"Pose track saved to: {track_path}")
 
-    video_path = sys.argv[1]
-    json_path = sys.argv[2]
-    output_path = sys.argv[3]
-    sport_type = sys.argv[4] if len(sys.argv) > 4 else "basketball"
+    print(f"Preview saved to: {output_path} ({frames_written} frames in {wall_time:.1f}s)")
+    if progress is not None:
+        progress(frame_count, total_frames)
+    return {
+        'frames': frame_count,
+        'frames_written': frames_written,
+        'fps': out_fps,
+        'width': size[0],
+        'height': size[1],
+        'wall_seconds': round(wall_time, 3)
+    }
 
-    with open(json_path, 'r') as f:
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Annotate a sports video with analysis data",
+        epilog="Example: python ball.py final_ball.mp4 sports.json final.mp4 basketball")
+    parser.add_argument("video_path")
+    parser.add_argument("sports_json")
+    parser.add_argument("output_path")
+    parser.add_argument("sport_type", nargs="?", default="basketball")
+    parser.add_argument("--pipelined", action="store_true", help="run decode/pose/overlay/encode on separate threads")
+    parser.add_argument("--segments", type=int, default=1, help="render this many frame ranges in parallel processes")
+    parser.add_argument("--pose-sampling", choices=["fixed", "adaptive"], default="fixed")
+    parser.add_argument("--pose-budget", type=float, default=0.5,
+                        help="adaptive sampling: pose calls as a fraction of the fixed stride")
+    parser.add_argument("--pose-resolution", type=int, default=None,
+                        help="longer side in pixels of the frames given to MediaPipe")
+    parser.add_argument("--encoder", choices=["auto", "ffmpeg", "opencv"], default="auto",
+                        help="ffmpeg encodes video and audio in one pass; opencv needs no ffmpeg for video")
+    parser.add_argument("--x264-preset", default="veryfast")
+    parser.add_argument("--encoder-threads", type=int, default=0, help="x264 threads (0 = automatic)")
+    parser.add_argument("--tts-workers", type=int, default=4, help="feedback clips synthesised at once")
+    parser.add_argument("--tts-overlap", action="store_true",
+                        help="keep synthesising speech while rendering (costs a second ffmpeg pass for the audio)")
+    pose_cache = parser.add_mutually_exclusive_group()
+    pose_cache.add_argument("--recompute-pose", dest="pose_cache", action="store_const", const="refresh",
+                            help="ignore any saved pose track and overwrite it")
+    pose_cache.add_argument("--pose-cache-only", dest="pose_cache", action="store_const", const="only",
+                            help="fail instead of running MediaPipe when no saved pose track exists")
+    pose_cache.add_argument("--no-pose-cache", dest="pose_cache", action="store_const", const="off",
+                            help="neither read nor write a saved pose track")
+    parser.set_defaults(pose_cache="auto")
+    parser.add_argument("--preview", metavar="PATH",
+                        help="first write a low-resolution silent preview here, sharing the pose track")
+    parser.add_argument("--preview-height", type=int, default=PREVIEW_HEIGHT)
+    parser.add_argument("--preview-fps", type=float, default=PREVIEW_FPS)
+    parser.add_argument("--preview-only", action="store_true", help="stop after the preview")
+    parser.add_argument("--progressive", metavar="DIR",
+                        help="also write an HLS playlist of fMP4 segments here while rendering")
+    args = parser.parse_args()
+
+    with open(args.sports_json, 'r') as f:
         analysis_data = json.load(f)
 
-    annotate_video(video_path, analysis_data, output_path, sport_type)
+    if args.preview:
+        annotate_preview(args.video_path, analysis_data, args.preview, args.sport_type,
+                         preview_height=args.preview_height, preview_fps=args.preview_fps,
+                         pose_sampling=args.pose_sampling, pose_budget=args.pose_budget,
+                         pose_resolution=args.pose_resolution, pose_cache=args.pose_cache)
+        if args.preview_only:
+            raise SystemExit(0)
+        if args.pose_cache == "refresh":
+            # The preview just recomputed the track; the full render replays it
+            args.pose_cache = "auto"
+
+    annotate_video(args.video_path, analysis_data, args.output_path, args.sport_type,
+                   pipelined=args.pipelined, segments=args.segments, pose_sampling=args.pose_sampling,
+                   pose_budget=args.pose_budget, pose_resolution=args.pose_resolution,
+                   pose_cache=args.pose_cache, encoder=args.encoder, x264_preset=args.x264_preset,
+                   encoder_threads=args.encoder_threads, tts_workers=args.tts_workers, tts_overlap=args.tts_overlap,
+                   progressive_dir=args.progressive)
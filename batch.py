@@ -0,0 +1,333 @@
+import os
+import json
+import shutil
+import threading
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+BATCH_ANALYSIS_WORKERS = int(os.getenv("BATCH_ANALYSIS_WORKERS", 4))
+BATCH_TTS_WORKERS = int(os.getenv("BATCH_TTS_WORKERS", 8))
+BATCH_RENDER_WORKERS = int(os.getenv("BATCH_RENDER_WORKERS", os.cpu_count() or 1))
+BATCH_QUEUE_LIMIT = int(os.getenv("BATCH_QUEUE_LIMIT", 2))
+BATCH_MAX_CLIPS = int(os.getenv("BATCH_MAX_CLIPS", 50))
+BATCH_RETENTION_SECONDS = float(os.getenv("BATCH_RETENTION_SECONDS", 3600))
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.mkv', '.avi', '.webm')
+
+def read_manifest(path, default_sport):
+    """(video_path, sport) pairs from a manifest file
+
+    One clip per line, either "path" or "path,sport". Blank lines and lines
+    starting with # are skipped; relative paths are taken from the
+    manifest's directory.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    clips = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            video_path, _, sport = line.partition(',')
+            clips.append((os.path.join(base, video_path.strip()), sport.strip().lower() or default_sport))
+    return clips
+
+def find_clips(source, default_sport):
+    """(video_path, sport) pairs for every video in a directory, or listed in a manifest"""
+    if not os.path.isdir(source):
+        return read_manifest(source, default_sport)
+    return [(os.path.join(source, name), default_sport) for name in sorted(os.listdir(source))
+            if name.lower().endswith(VIDEO_EXTENSIONS)]
+
+def clip_output_dirs(clips, output_dir):
+    """One output directory per clip, named after the video and made unique"""
+    seen = {}
+    dirs = []
+    for video_path, _ in clips:
+        name = os.path.splitext(os.path.basename(video_path))[0]
+        seen[name] = seen.get(name, 0) + 1
+        dirs.append(os.path.join(output_dir, name if seen[name] == 1 else f"{name}-{seen[name]}"))
+    return dirs
+
+def render_clip(video_path, analysis_data, output_path, sport, video_hash, encoder_threads):
+    """Annotate one clip in a render worker; returns (frames, seconds)"""
+    from ball import annotate_video
+
+    started = time.time()
+    stats = annotate_video(video_path, analysis_data, output_path, sport, video_hash=video_hash,
+                           encoder_threads=encoder_threads)
+    return stats['frames'], time.time() - started
+
+def throughput_summary(results, wall_seconds):
+    """Totals and clips/hour, frames/second over a batch's results"""
+    done = [result for result in results if result['status'] == 'done']
+    frames = sum(result['frames'] for result in done)
+    return {
+        'clips': len(results),
+        'succeeded': len(done),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'frames': frames,
+        'wall_seconds': round(wall_seconds, 3),
+        'clips_per_hour': round(len(done) * 3600 / wall_seconds, 1) if wall_seconds > 0 else None,
+        'frames_per_second': round(frames / wall_seconds, 1) if wall_seconds > 0 else None
+    }
+
+def print_summary(summary, results):
+    print("Batch results:")
+    for result in results:
+        if result['status'] == 'done':
+            print(f"  {result['video']}: {result['frames']} frames, analysis {result['analysis_seconds']:.1f}s, "
+                  f"render {result['render_seconds']:.1f}s")
+        else:
+            print(f"  {result['video']}: {result['status']} {result['error'] or ''}")
+    print(f"{summary['succeeded']}/{summary['clips']} clips in {summary['wall_seconds']:.1f}s: "
+          f"{summary['clips_per_hour']} clips/hour, {summary['frames_per_second']} frames/sec")
+
+def run_batch(clips, output_dir, analysis_workers=BATCH_ANALYSIS_WORKERS, render_workers=BATCH_RENDER_WORKERS,
+              tts_workers=BATCH_TTS_WORKERS, use_cache=True, video_hashes=None, on_update=None):
+    """Analyse and annotate many clips, overlapping the network and CPU stages
+
+    Each clip is analysed with Gemini on one of analysis_workers threads,
+    and its feedback speech is synthesised into the speech cache on
+    tts_workers threads, starting as soon as items stream in. The clip is
+    then annotated in a pool of render_workers processes (one per core by
+    default), whose renders hit the speech cache for their audio. x264's
+    threads are divided between the render workers.
+
+    clips is a list of (video_path, sport). Each clip's analysis.json and
+    <sport>_annotated.mp4 go in their own directory under output_dir, and
+    batch_summary.json holds the per-clip results and throughput.
+    on_update(index, result), if given, is called whenever a clip's status
+    changes (queued, analyzing, rendering, done or failed).
+
+    Returns the summary dict.
+    """
+    from analysis import ITEM_KEYS, analyze_video
+    from common import file_sha256
+    from jobs import FeedbackPrefetch
+
+    lock = threading.Lock()
+    results = [{
+        'video': video_path,
+        'sport': sport,
+        'status': 'queued',
+        'error': None,
+        'analysis_path': os.path.join(clip_dir, "analysis.json"),
+        'video_output_path': os.path.join(clip_dir, f"{sport}_annotated.mp4"),
+        'video_hash': video_hashes[i] if video_hashes else None,
+        'frames': 0,
+        'analysis_seconds': None,
+        'render_seconds': None
+    } for i, ((video_path, sport), clip_dir) in enumerate(zip(clips, clip_output_dirs(clips, output_dir)))]
+
+    def update(i, **fields):
+        with lock:
+            results[i].update(fields)
+            result = dict(results[i])
+        if on_update is not None:
+            on_update(i, result)
+
+    encoder_threads = max(1, (os.cpu_count() or 1) // render_workers)
+    render_futures = []
+    wall_start = time.time()
+
+    with ThreadPoolExecutor(max_workers=tts_workers) as tts_pool, \
+            ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context("spawn")) as render_pool:
+
+        def finish_render(i, future):
+            try:
+                frames, seconds = future.result()
+                update(i, status='done', frames=frames, render_seconds=round(seconds, 3))
+            except Exception as e:
+                update(i, status='failed', error=str(e))
+
+        def prepare(i):
+            """Analyse a clip and synthesise its speech, then hand it to the render pool"""
+            result = results[i]
+            video_path, sport = result['video'], result['sport']
+            try:
+                update(i, status='analyzing')
+                started = time.time()
+                os.makedirs(os.path.dirname(result['analysis_path']), exist_ok=True)
+                video_hash = result['video_hash'] or file_sha256(video_path)
+
+                prefetch = FeedbackPrefetch(tts_pool)
+                analysis_data = analyze_video(video_path, sport, result['analysis_path'], video_hash=video_hash,
+                                              use_cache=use_cache, on_item=prefetch)
+                # Cached analyses don't stream, so anything not yet requested is fetched now
+                for item in analysis_data.get(ITEM_KEYS[sport], []):
+                    prefetch(item)
+                prefetch.wait()
+
+                update(i, status='rendering', video_hash=video_hash,
+                       analysis_seconds=round(time.time() - started, 3))
+                future = render_pool.submit(render_clip, video_path, analysis_data, result['video_output_path'],
+                                            sport, video_hash, encoder_threads)
+                future.add_done_callback(lambda f: finish_render(i, f))
+                with lock:
+                    render_futures.append(future)
+            except Exception as e:
+                print(f"Error analysing {video_path}: {e}")
+                update(i, status='failed', error=str(e))
+
+        with ThreadPoolExecutor(max_workers=analysis_workers) as analysis_pool:
+            list(analysis_pool.map(prepare, range(len(results))))
+        wait(render_futures)
+
+    summary = throughput_summary(results, time.time() - wall_start)
+    summary['results'] = results
+
+    os.makedirs(output_dir, exist_ok=True)
+    summary_path = os.path.join(output_dir, "batch_summary.json")
+    temp_path = f"{summary_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(temp_path, summary_path)
+
+    print_summary(summary, results)
+    print(f"Batch summary saved to: {summary_path}")
+    return summary
+
+class BatchManager:
+    """Runs uploaded batches one after another on a background thread
+
+    A running batch already spreads its renders over every core, so batches
+    are queued rather than run side by side; submit raises JobQueueFull
+    once queue_limit batches are waiting. Each clip's outputs are moved into
+    the OutputStore as soon as it is done. Finished batches are forgotten
+    after retention seconds.
+    """
+
+    def __init__(self, queue_limit=BATCH_QUEUE_LIMIT, retention=BATCH_RETENTION_SECONDS):
+        self.queue_limit = queue_limit
+        self.retention = retention
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, uploads, output_dir, refresh=False):
+        """Queue a batch of (video_path, sport, sha256, filename) uploads and return its ID"""
+        from jobs import JobQueueFull
+
+        with self.lock:
+            self.prune()
+            waiting = sum(1 for batch in self.batches.values() if batch['status'] == 'queued')
+            if waiting >= self.queue_limit:
+                raise JobQueueFull(f"{waiting} batches already queued")
+
+            batch_id = uuid.uuid4().hex
+            self.batches[batch_id] = {
+                'batch_id': batch_id,
+                'status': 'queued',
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'error': None,
+                'clips': [{'video': filename, 'sport': sport, 'status': 'queued',
+                           'error': None, 'frames': 0, 'analysis': None, 'annotated_video': None}
+                          for _, sport, _, filename in uploads],
+                'summary': None
+            }
+        self.executor.submit(self.run, batch_id, uploads, os.path.join(output_dir, "batches", batch_id), refresh)
+        return batch_id
+
+    def run(self, batch_id, uploads, work_dir, refresh):
+        from output_store import OutputStore
+
+        store = OutputStore()
+        batch = self.batches[batch_id]
+
+        def store_clip(i, result, clip):
+            try:
+                clip['analysis'] = store.put(result['analysis_path'], '.json')
+                if os.path.exists(result['video_output_path']):
+                    clip['annotated_video'] = store.put(result['video_output_path'], '.mp4')
+            except Exception as e:
+                clip.update(status='failed', error=f"Could not store outputs: {e}")
+            with self.lock:
+                batch['clips'][i].update(clip)
+
+        def on_update(i, result):
+            clip = {'status': result['status'], 'error': result['error'], 'frames': result['frames']}
+            if result['status'] == 'done':
+                # Hashing and moving the outputs would hold up the render pool's callback thread
+                store_pool.submit(store_clip, i, result, clip)
+                return
+            with self.lock:
+                batch['clips'][i].update(clip)
+
+        with self.lock:
+            batch['status'] = 'running'
+            batch['started_at'] = time.time()
+        try:
+            # Leaving the with block waits for the outputs to be stored, before work_dir is removed
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix="batch-store") as store_pool:
+                summary = run_batch([(video_path, sport) for video_path, sport, _, _ in uploads], work_dir,
+                                    use_cache=not refresh, video_hashes=[sha256 for _, _, sha256, _ in uploads],
+                                    on_update=on_update)
+            summary.pop('results')
+            with self.lock:
+                batch['summary'] = summary
+                batch['status'] = 'done'
+        except Exception as e:
+            print(f"Batch {batch_id} failed: {e}")
+            with self.lock:
+                batch['status'] = 'failed'
+                batch['error'] = str(e)
+        finally:
+            with self.lock:
+                batch['finished_at'] = time.time()
+            for video_path, _, _, _ in uploads:
+                if os.path.exists(video_path):
+                    os.remove(video_path)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def prune(self):
+        cutoff = time.time() - self.retention
+        for batch_id in [batch_id for batch_id, batch in self.batches.items()
+                         if batch['finished_at'] is not None and batch['finished_at'] < cutoff]:
+            del self.batches[batch_id]
+
+    def get(self, batch_id):
+        """Copy of a batch record with its per-clip status, or None"""
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            return dict(batch, clips=[dict(clip) for clip in batch['clips']])
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Analyse and annotate every clip in a directory or manifest",
+        epilog="Example: python batch.py practice_clips/ results/ --sport basketball")
+    parser.add_argument("source", help="directory of videos, or a manifest with one 'path[,sport]' per line")
+    parser.add_argument("output_dir")
+    parser.add_argument("--sport", default="basketball", help="sport for clips the manifest doesn't name one for")
+    parser.add_argument("--analysis-workers", type=int, default=BATCH_ANALYSIS_WORKERS,
+                        help="clips analysed by Gemini at once")
+    parser.add_argument("--tts-workers", type=int, default=BATCH_TTS_WORKERS,
+                        help="feedback clips synthesised at once")
+    parser.add_argument("--render-workers", type=int, default=BATCH_RENDER_WORKERS,
+                        help="clips annotated at once, in separate processes")
+    parser.add_argument("--no-cache", action="store_true", help="re-run analysis for clips analysed before")
+    args = parser.parse_args()
+
+    from analysis import VALIDATORS
+
+    clips = find_clips(args.source, args.sport.lower())
+    if not clips:
+        parser.error(f"No videos found in {args.source}")
+    unsupported = sorted({sport for _, sport in clips if sport not in VALIDATORS})
+    if unsupported:
+        parser.error(f"Unsupported sports: {', '.join(unsupported)}. Supported sports: {', '.join(VALIDATORS)}")
+    print(f"Processing {len(clips)} clips")
+
+    run_batch(clips, args.output_dir, analysis_workers=args.analysis_workers, render_workers=args.render_workers,
+              tts_workers=args.tts_workers, use_cache=not args.no_cache)
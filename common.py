@@ -0,0 +1,21 @@
+import hashlib
+
+# Key of the per-item list in each sport's analysis JSON
+ITEM_KEYS = {
+    "basketball": "shots",
+    "soccer": "events",
+    "tennis": "shots"
+}
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Hex sha256 of a file's contents, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def parse_timestamp(timestamp):
+    """Seconds in an M:SS(.s) timestamp as the analysis writes them"""
+    minutes, seconds = timestamp.split(':')
+    return float(minutes) * 60 + float(seconds)
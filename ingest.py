@@ -0,0 +1,246 @@
+import os
+import asyncio
+import hashlib
+import tempfile
+import aiofiles
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    # python-multipart before 0.0.13 only installs the multipart package
+    from multipart.multipart import MultipartParser, parse_options_header
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 2 * 1024 ** 3))
+# Room for the multipart framing and the text fields around the files
+UPLOAD_FORM_OVERHEAD = 1024 * 1024
+MAX_FIELD_BYTES = 64 * 1024
+# Enough of a file to tell its container apart; MPEG-TS needs two 188-byte packets
+SNIFF_BYTES = 189
+
+class UploadRejected(Exception):
+    """An upload that can't be accepted, with the HTTP status to answer it with"""
+
+    def __init__(self, status_code, detail, filename=None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.filename = filename
+
+def sniff_container(head):
+    """Name of the video container the first bytes of a file belong to, or None"""
+    if head[4:8] == b'ftyp':
+        return 'mp4'
+    if head[:4] == b'\x1a\x45\xdf\xa3':
+        return 'matroska'
+    if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+        return 'avi'
+    if head[:3] == b'FLV':
+        return 'flv'
+    if head[:4] == b'\x00\x00\x01\xba':
+        return 'mpeg-ps'
+    if len(head) > 188 and head[0] == 0x47 and head[188] == 0x47:
+        return 'mpeg-ts'
+    # QuickTime files without an ftyp box start straight with a top-level atom
+    if head[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip'):
+        return 'mp4'
+    return None
+
+def probe_video(path):
+    """fps, size and duration of a video, or None if OpenCV can't decode a frame of it"""
+    import cv2
+
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            return None
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        ok, _ = cap.read()
+        if not ok or fps <= 0:
+            return None
+        return {
+            'fps': fps,
+            'width': width,
+            'height': height,
+            'duration': round(frames / fps, 3)
+        }
+    finally:
+        cap.release()
+
+class FormFile:
+    """One file part of a multipart body, written, hashed and checked as it arrives"""
+
+    def __init__(self, filename, content_type, directory, max_bytes):
+        self.filename = filename
+        self.content_type = content_type
+        self.max_bytes = max_bytes
+        suffix = os.path.splitext(filename)[1].lower()
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix=suffix if suffix.isascii() else '')
+        os.close(fd)
+        self.file = None
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.container = None
+
+    def sniff(self):
+        self.container = sniff_container(self.head)
+        if self.container is None:
+            raise UploadRejected(415, "Uploaded file is not a recognised video container")
+
+    async def write(self, chunk):
+        if self.file is None:
+            self.file = await aiofiles.open(self.path, 'wb')
+        if self.container is None:
+            self.head += chunk[:SNIFF_BYTES - len(self.head)]
+            if len(self.head) >= SNIFF_BYTES:
+                self.sniff()
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadRejected(413, f"Upload is larger than {self.max_bytes / (1024 * 1024):.0f} MB")
+        self.digest.update(chunk)
+        await self.file.write(chunk)
+
+    async def close(self):
+        if self.file is not None:
+            await self.file.close()
+            self.file = None
+
+    async def finish(self):
+        """Check the complete file and return its metadata"""
+        await self.close()
+        if self.size == 0:
+            raise UploadRejected(400, "Uploaded file is empty")
+        if self.container is None:
+            self.sniff()
+        metadata = await asyncio.to_thread(probe_video, self.path)
+        if metadata is None:
+            raise UploadRejected(422, "Uploaded video could not be decoded")
+        return dict(metadata, path=self.path, filename=self.filename, sha256=self.digest.hexdigest(),
+                    size=self.size, container=self.container)
+
+class UploadForm:
+    """The parts of a multipart/form-data body, handled as the parser reports them
+
+    MultipartParser calls back synchronously, so its callbacks only queue
+    events; handle_events then processes them, writing file parts
+    asynchronously.
+    """
+
+    def __init__(self, boundary, directory, max_bytes, max_files):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.fields = {}
+        self.files = []
+        self.uploads = []
+        self.part = None
+        self.done = False
+        self.events = []
+        self.header = {}
+        self.parser = MultipartParser(boundary, {
+            'on_part_begin': lambda: self.events.append(('begin',)),
+            'on_header_field': lambda data, start, end: self.add_header('field', data[start:end]),
+            'on_header_value': lambda data, start, end: self.add_header('value', data[start:end]),
+            'on_header_end': lambda: self.events.append(('header', self.header.pop('field', b'').lower(),
+                                                         self.header.pop('value', b''))),
+            'on_headers_finished': lambda: self.events.append(('headers',)),
+            'on_part_data': lambda data, start, end: self.events.append(('data', bytes(data[start:end]))),
+            'on_part_end': lambda: self.events.append(('end',)),
+            'on_end': lambda: self.events.append(('done',))
+        })
+
+    def add_header(self, key, data):
+        # A header can be split across two writes
+        self.header[key] = self.header.get(key, b'') + data
+
+    async def write(self, chunk):
+        try:
+            self.parser.write(chunk)
+        except ValueError:
+            raise UploadRejected(400, "Malformed multipart body")
+        try:
+            for event in self.events:
+                await self.handle(*event)
+        except UploadRejected as e:
+            if self.part is not None and 'file' in self.part:
+                e.filename = self.part['file'].filename
+            raise
+        self.events.clear()
+
+    async def handle(self, event, *args):
+        part = self.part
+        if event == 'begin':
+            self.part = {'headers': {}, 'value': b''}
+        elif event == 'header':
+            part['headers'][args[0]] = args[1]
+        elif event == 'headers':
+            _, params = parse_options_header(part['headers'].get(b'content-disposition'))
+            part['name'] = params.get(b'name', b'').decode('utf-8', 'replace')
+            if b'filename' in params:
+                filename = params[b'filename'].decode('utf-8', 'replace')
+                content_type = part['headers'].get(b'content-type', b'').decode('latin-1')
+                if not content_type.startswith('video/'):
+                    raise UploadRejected(400, f"{filename} is not a video", filename)
+                if len(self.files) == self.max_files:
+                    raise UploadRejected(400, f"At most {self.max_files} videos per request")
+                part['file'] = FormFile(filename, content_type, self.directory, self.max_bytes)
+                self.files.append(part['file'])
+        elif event == 'data':
+            if 'file' in part:
+                await part['file'].write(args[0])
+            else:
+                part['value'] += args[0]
+                if len(part['value']) > MAX_FIELD_BYTES:
+                    raise UploadRejected(400, f"Form field {part['name']} is too long")
+        elif event == 'end':
+            if 'file' in part:
+                self.uploads.append(await part['file'].finish())
+            else:
+                self.fields[part['name']] = part['value'].decode('utf-8', 'replace')
+            self.part = None
+        elif event == 'done':
+            self.done = True
+
+    async def discard(self):
+        for upload in self.files:
+            await upload.close()
+            if os.path.exists(upload.path):
+                os.remove(upload.path)
+
+async def read_upload_form(request, directory, max_bytes=MAX_UPLOAD_BYTES, max_files=1):
+    """Read a multipart/form-data request body straight off the socket
+
+    Each file part is written to a new file in directory, hashed and
+    size-checked chunk by chunk as the body arrives, and its container is
+    sniffed from the first bytes, so a non-video, oversized or chunked
+    upload without a Content-Length is refused without reading the rest.
+    Finished files must decode with OpenCV.
+
+    Returns (fields, uploads): the text fields by name, and a dict per file
+    as in FormFile.finish. Raises UploadRejected otherwise, with filename
+    set for errors in a file part, and removes every file written.
+    """
+    content_type, options = parse_options_header(request.headers.get('content-type'))
+    if content_type != b'multipart/form-data' or not options.get(b'boundary'):
+        raise UploadRejected(400, "Expected a multipart/form-data body")
+    max_body_bytes = max_bytes * max_files + UPLOAD_FORM_OVERHEAD
+
+    form = UploadForm(options[b'boundary'], directory, max_bytes, max_files)
+    body_size = 0
+    try:
+        async for chunk in request.stream():
+            body_size += len(chunk)
+            if body_size > max_body_bytes:
+                raise UploadRejected(413, f"Upload is larger than {max_body_bytes / (1024 * 1024):.0f} MB")
+            await form.write(chunk)
+        form.parser.finalize()
+        if not form.done:
+            raise UploadRejected(400, "Incomplete multipart body")
+    except BaseException:
+        await form.discard()
+        raise
+
+    return form.fields, form.uploads
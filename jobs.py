@@ -0,0 +1,337 @@
+import os
+import shutil
+import time
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", 8))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", 3600))
+JOB_PREWARM = os.getenv("JOB_PREWARM", "1") != "0"
+
+class JobQueueFull(Exception):
+    """Raised by JobManager.submit when every worker is busy and the queue is full"""
+
+class JobCancelled(Exception):
+    """Raised inside run_job once the job's cancel_event is set"""
+
+_speech_prefetch = None
+
+class FeedbackPrefetch:
+    """Synthesises a job's feedback lines into the speech cache in the background
+
+    Use as analyze_video's on_item. Each distinct line is requested once,
+    however often it is streamed (overlapping analysis windows can pass an
+    item twice). wait() blocks until every requested line is cached, so
+    the render that follows gets cache hits rather than asking ElevenLabs
+    for the same text again.
+
+    Lines are synthesised on executor, or on a shared pool of four threads
+    if it is None.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.requested = set()
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        global _speech_prefetch
+        from voice import prefetch_speech
+
+        text = item.get('feedback')
+        with self.lock:
+            if not text or text in self.requested:
+                return
+            self.requested.add(text)
+            executor = self.executor
+            if executor is None:
+                if _speech_prefetch is None:
+                    _speech_prefetch = ThreadPoolExecutor(max_workers=4)
+                executor = _speech_prefetch
+            self.futures.append(executor.submit(prefetch_speech, text))
+
+    def wait(self):
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+
+def warm_worker():
+    """Load the heavy modules and models once when a worker process starts
+
+    Runs as the pool initializer, so MediaPipe Pose and the Gemini model
+    are ready before the first job reaches the worker instead of being
+    loaded inside it.
+    """
+    started = time.time()
+    import analysis
+    import ball
+
+    ball.get_pose()
+    try:
+        analysis.get_model()
+    except ValueError as e:
+        print(f"Warning: Gemini model not preloaded: {e}")
+    print(f"Worker {os.getpid()} ready in {time.time() - started:.1f}s")
+
+def worker_ready():
+    return os.getpid()
+
+def run_job(job_id, video_path, sport, video_hash, refresh, output_dir, progress, preview=False, stream_dir=None,
+            cancel_event=None):
+    """Analyse and annotate one upload in a worker process
+
+    Stage and frame counts are written to the shared progress dict as the
+    job goes. Outputs are written under output_dir and then moved into the
+    OutputStore; the result holds their store keys. The upload and
+    output_dir are removed when the job ends, whatever the outcome.
+
+    With preview, a low-resolution preview is rendered before the full
+    video and its store key published in the progress dict as soon as it
+    is ready. The full render then replays the preview's pose track.
+
+    With stream_dir, the full render is also written there as a growing HLS
+    playlist (see ball.HLSWriter). That directory outlives the job; the
+    JobManager removes it with the job record.
+
+    Setting cancel_event stops the job: the Gemini wait is abandoned, and
+    rendering stops at its next progress report with JobCancelled.
+    """
+    from analysis import ITEM_KEYS, analyze_video, file_poller
+    from ball import annotate_preview, annotate_video
+    from output_store import OutputStore
+
+    def report(stage, **fields):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled("Job was cancelled")
+        progress[job_id] = dict(progress.get(job_id, {}), stage=stage, **fields)
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        analysis_path = os.path.join(output_dir, "analysis.json")
+        video_output_path = os.path.join(output_dir, f"{sport}_annotated.mp4")
+
+        report("analyzing")
+        prefetch = FeedbackPrefetch()
+        analysis_data = analyze_video(video_path, sport, analysis_path, video_hash=video_hash,
+                                      use_cache=not refresh, on_item=prefetch, cancel_event=cancel_event)
+        # Cached analyses don't stream, so anything not yet requested is fetched now
+        for item in analysis_data.get(ITEM_KEYS[sport], []):
+            prefetch(item)
+        # How long Gemini has been taking to process this worker's uploads
+        report("analyzed", gemini_processing=file_poller.stats())
+
+        store = OutputStore()
+        preview_key = None
+        if preview:
+            preview_path = os.path.join(output_dir, f"{sport}_preview.mp4")
+            report("previewing", frames_processed=0)
+            annotate_preview(video_path, analysis_data, preview_path, sport, video_hash=video_hash,
+                             progress=lambda done, total: report("previewing", frames_processed=done, total_frames=total))
+            preview_key = store.put(preview_path, '.mp4')
+
+        report("synthesizing", preview=preview_key)
+        prefetch.wait()
+
+        report("annotating", frames_processed=0)
+        annotate_video(video_path, analysis_data, video_output_path, sport, video_hash=video_hash,
+                       progress=lambda done, total: report("annotating", frames_processed=done, total_frames=total),
+                       progressive_dir=stream_dir)
+
+        result = {
+            'analysis': store.put(analysis_path, '.json'),
+            'video': store.put(video_output_path, '.mp4') if os.path.exists(video_output_path) else None,
+            'preview': preview_key
+        }
+        report("done")
+        return result
+    finally:
+        if os.path.exists(video_path):
+            os.remove(video_path)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+class JobManager:
+    """Runs analysis jobs on a bounded pool of worker processes
+
+    At most workers jobs run at once and queue_limit more wait for a slot;
+    submit raises JobQueueFull beyond that. cancel drops a queued job or
+    signals a running one to stop. Finished jobs, and their HLS stream
+    directories, are forgotten after retention seconds.
+
+    If a worker process dies (killed for memory, or a crash in native
+    code), the jobs on that pool fail and a fresh pool takes its place.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, queue_limit=JOB_QUEUE_LIMIT, retention=JOB_RETENTION_SECONDS):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.retention = retention
+        self.jobs = {}
+        self.futures = {}
+        self.cancel_events = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.manager = None
+        self.progress = None
+
+    def start(self):
+        """Create the worker pool and the shared progress dict, once"""
+        if self.executor is None:
+            context = multiprocessing.get_context("spawn")
+            self.manager = context.Manager()
+            self.progress = self.manager.dict()
+            self.create_pool()
+
+    def create_pool(self):
+        """Start a new worker pool
+
+        With JOB_PREWARM set (the default) every worker is started and
+        warmed straight away rather than on the first job.
+        """
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=warm_worker)
+        if JOB_PREWARM:
+            # The pool only spawns processes as work arrives; start them all now
+            for _ in range(self.workers):
+                self.executor.submit(worker_ready)
+
+    def replace_pool(self, broken):
+        """Swap a broken pool for a new one, unless that has already happened"""
+        if broken is not self.executor:
+            return
+        print("Warning: A job worker process died; starting a new worker pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.create_pool()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.manager.shutdown()
+            self.executor = None
+
+    def active_jobs(self):
+        return sum(1 for job in self.jobs.values() if job['status'] in ('queued', 'running'))
+
+    def submit(self, video_path, sport, video_hash, refresh, output_dir, preview=False, stream=False):
+        """Queue a job and return its ID
+
+        With stream, the annotated video is also published as HLS under
+        output_dir/streams/<job_id> while it renders.
+        """
+        with self.lock:
+            self.start()
+            self.prune()
+            if self.active_jobs() >= self.workers + self.queue_limit:
+                raise JobQueueFull(f"{self.active_jobs()} jobs already queued or running")
+
+            job_id = uuid.uuid4().hex
+            work_dir = os.path.join(output_dir, "jobs", job_id)
+            stream_dir = os.path.join(output_dir, "streams", job_id) if stream else None
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'sport': sport,
+                'status': 'queued',
+                'created_at': time.time(),
+                'finished_at': None,
+                'error': None,
+                'result': None,
+                'video_path': video_path,
+                'work_dir': work_dir,
+                'stream_dir': stream_dir,
+                'cancel_requested': False
+            }
+            self.cancel_events[job_id] = self.manager.Event()
+            args = (run_job, job_id, video_path, sport, video_hash, refresh, work_dir, self.progress, preview,
+                    stream_dir, self.cancel_events[job_id])
+            try:
+                future = self.executor.submit(*args)
+            except BrokenProcessPool:
+                # A worker died since the last job finished; retry once on a fresh pool
+                self.replace_pool(self.executor)
+                future = self.executor.submit(*args)
+            executor = self.executor
+            self.futures[job_id] = future
+        future.add_done_callback(lambda f: self.finish(job_id, f, executor))
+        return job_id
+
+    def cancel(self, job_id):
+        """Stop a job; returns False if it had already finished and None if it is unknown
+
+        A queued job is dropped straight away. A running one is signalled
+        through its cancel event and is marked failed once it has stopped.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job['finished_at'] is not None:
+                return False
+            job['cancel_requested'] = True
+            future = self.futures[job_id]
+            self.cancel_events[job_id].set()
+        # A cancelled future runs finish() straight away, which takes the lock
+        future.cancel()
+        return True
+
+    def finish(self, job_id, future, executor=None):
+        with self.lock:
+            job = self.jobs[job_id]
+            job['finished_at'] = time.time()
+            self.futures.pop(job_id, None)
+            if future.cancelled() or isinstance(future.exception(), BrokenProcessPool):
+                # run_job never ran, or died before its own cleanup
+                if os.path.exists(job['video_path']):
+                    os.remove(job['video_path'])
+                shutil.rmtree(job['work_dir'], ignore_errors=True)
+            if future.cancelled() or (job['cancel_requested'] and future.exception() is not None):
+                job['status'] = 'failed'
+                job['error'] = "Job was cancelled"
+            elif isinstance(future.exception(), BrokenProcessPool):
+                # Every job on the dead pool lands here; only the first replaces it
+                job['status'] = 'failed'
+                job['error'] = "Worker process died before the job finished"
+                self.replace_pool(executor)
+            elif future.exception() is not None:
+                job['status'] = 'failed'
+                job['error'] = str(future.exception())
+            else:
+                job['status'] = 'done'
+                job['result'] = future.result()
+
+    def prune(self):
+        cutoff = time.time() - self.retention
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job['finished_at'] is not None and job['finished_at'] < cutoff]:
+            job = self.jobs.pop(job_id)
+            self.progress.pop(job_id, None)
+            self.cancel_events.pop(job_id, None)
+            if job['stream_dir']:
+                shutil.rmtree(job['stream_dir'], ignore_errors=True)
+
+    def latest(self, sport=None):
+        """ID of the most recently finished successful job, optionally for one sport"""
+        with self.lock:
+            done = [job for job in self.jobs.values()
+                    if job['status'] == 'done' and (sport is None or job['sport'] == sport)]
+        if not done:
+            return None
+        return max(done, key=lambda job: job['finished_at'])['job_id']
+
+    def get(self, job_id):
+        """Job record merged with the worker's latest progress, or None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+        progress = self.progress.get(job_id, {})
+        if job['status'] == 'queued' and progress:
+            job['status'] = 'running'
+        job.update(progress)
+        if job['status'] == 'failed':
+            job['stage'] = 'failed'
+        return job
@@ -1,10 +1,21 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+import os
+import re
+import json
 import shutil
+import tempfile
+import aiofiles
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
-from analysis import analyze_video
-from ball import annotate_video
+from batch import BATCH_MAX_CLIPS, BatchManager
+from common import ITEM_KEYS
+from ingest import MAX_UPLOAD_BYTES, UPLOAD_FORM_OVERHEAD, UploadRejected, read_upload_form
+from jobs import JobManager, JobQueueFull
+from output_store import OutputStore
+from voice import aclose_async_client, agenerate_speech
 
 app = FastAPI(title="Sports Video Analysis API")
 
@@ -25,6 +36,39 @@ OUTPUT_DIR.mkdir(exist_ok=True)
 
 SUPPORTED_SPORTS = ["basketball", "soccer", "tennis"]
 
+# Files ball.HLSWriter writes into a job's stream directory
+STREAM_PLAYLIST = "index.m3u8"
+STREAM_FILE_PATTERN = re.compile(r'^(index\.m3u8|init\.mp4|seg_\d+\.m4s)$')
+
+# Analysis and annotation run in worker processes, so long videos don't
+# block the event loop
+job_manager = JobManager()
+batch_manager = BatchManager()
+output_store = OutputStore()
+
+@app.on_event("startup")
+def start_workers():
+    job_manager.start()
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    job_manager.shutdown()
+    batch_manager.shutdown()
+
+@app.on_event("shutdown")
+async def close_speech_client():
+    await aclose_async_client()
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Refuse bodies that are declared too large before any of them is read"""
+    content_length = request.headers.get("content-length")
+    max_bytes = MAX_UPLOAD_BYTES * (BATCH_MAX_CLIPS if request.url.path == "/analyze/batch" else 1)
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + UPLOAD_FORM_OVERHEAD:
+        return JSONResponse(status_code=413,
+                            content={"detail": f"Upload is larger than {max_bytes / (1024 * 1024):.0f} MB"})
+    return await call_next(request)
+
 @app.get("/")
 async def root():
     return {"message": "Sports Video Analysis API", "version": "1.0.0"}
@@ -34,110 +78,390 @@ async def get_supported_sports():
     """Get list of supported sports"""
     return {"sports": SUPPORTED_SPORTS}
 
-@app.post("/analyze")
-async def analyze_video(
-    sport: str = Form(...),
-    video: UploadFile = File(...)
-):
+def form_flag(fields, name):
+    """A boolean form field, false when absent"""
+    value = fields.get(name, '').strip().lower()
+    if value in ('1', 'true', 'on', 'yes'):
+        return True
+    if value in ('', '0', 'false', 'off', 'no'):
+        return False
+    raise HTTPException(status_code=400, detail=f"{name} must be true or false")
+
+def form_sport(fields):
+    sport = fields.get('sport', '')
+    if sport.lower() not in SUPPORTED_SPORTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported sport: {sport}. Supported sports: {SUPPORTED_SPORTS}"
+        )
+    return sport.lower()
+
+def remove_uploads(uploads):
+    for upload in uploads:
+        if os.path.exists(upload['path']):
+            os.remove(upload['path'])
+
+@app.post("/analyze", status_code=202)
+async def submit_analysis(request: Request):
     """
-    Analyze a sports video
+    Queue a sports video for analysis
 
-    Parameters:
+    Form fields (multipart/form-data):
     - sport: The sport type (basketball, soccer, or tennis)
     - video: The video file to analyze
+    - refresh: Re-run the analysis even if this clip was analysed before
+    - preview: Also render a low-resolution preview, available at
+      /jobs/{job_id}/preview before the full video is done
+    - stream: Publish the annotated video as HLS at
+      /jobs/{job_id}/stream/index.m3u8 while it is rendering (400 if the
+      server has no ffmpeg)
 
     Returns:
-    - analysis: JSON analysis data
-    - annotated_video_path: Path to the annotated video
+    - job_id: ID to poll at /jobs/{job_id}
+    - status_url: Where to poll
+    - video: sha256, size and probed fps/resolution/duration of the upload
+
+    The body is read as it arrives (see ingest.read_upload_form). Responds
+    413 for uploads over MAX_UPLOAD_BYTES, 415/422 for files that aren't
+    decodable video, and 503 when the worker pool and its queue are full.
     """
 
-    if sport.lower() not in SUPPORTED_SPORTS:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported sport: {sport}. Supported sports: {SUPPORTED_SPORTS}"
-        )
+    if job_manager.active_jobs() >= job_manager.workers + job_manager.queue_limit:
+        raise HTTPException(status_code=503, detail="Too many jobs in progress, try again later",
+                            headers={"Retry-After": "30"})
 
-    # Validate video file
-    if not video.content_type or not video.content_type.startswith('video/'):
-        raise HTTPException(
-            status_code=400,
-            detail="Uploaded file must be a video"
-        )
+    try:
+        # The hash taken while the upload streams in is the key for every cache downstream
+        fields, uploads = await read_upload_form(request, UPLOAD_DIR)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
     try:
-        video_filename = f"{sport}_{video.filename}"
-        video_path = UPLOAD_DIR / video_filename
+        sport = form_sport(fields)
+        refresh, preview, stream = (form_flag(fields, name) for name in ('refresh', 'preview', 'stream'))
+        if stream and shutil.which('ffmpeg') is None:
+            # Otherwise the job would only fail once analysis and speech are done
+            raise HTTPException(status_code=400, detail="Streaming needs ffmpeg, which this server doesn't have")
+        if not uploads:
+            raise HTTPException(status_code=400, detail="No video uploaded")
+        upload = uploads[0]
 
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
+        print(f"Video saved to: {upload['path']} ({upload['size'] / 1e6:.1f} MB, "
+              f"{upload['width']}x{upload['height']} @ {upload['fps']:.2f} fps, {upload['duration']:.1f}s)")
 
-        print(f"Video saved to: {video_path}")
+        job_id = job_manager.submit(upload['path'], sport, upload['sha256'], refresh, str(OUTPUT_DIR),
+                                    preview, stream)
 
-        analysis_output_path = OUTPUT_DIR / "sports.json"
+    except HTTPException:
+        remove_uploads(uploads)
+        raise
 
-        print(f"Starting analysis for {sport}...")
-        analysis_data = analyze_video(
-            str(video_path),
-            sport.lower(),
-            str(analysis_output_path)
-        )
+    except JobQueueFull as e:
+        remove_uploads(uploads)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
 
-        print(f"Analysis complete. Results saved to: {analysis_output_path}")
+    except Exception as e:
+        print(f"Error queueing analysis: {e}")
+        remove_uploads(uploads)
+        raise HTTPException(status_code=500, detail=str(e))
 
-        annotated_video_path = OUTPUT_DIR / f"{sport}_annotated.mp4"
+    print(f"Queued job {job_id} for {sport}")
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "sport": sport,
+        "status_url": f"/jobs/{job_id}",
+        "video": {key: upload[key] for key in ('sha256', 'size', 'fps', 'width', 'height', 'duration')}
+    }
 
-        print("Generating annotated video...")
-        annotate_video(
-            str(video_path),
-            analysis_data,
-            str(annotated_video_path),
-            sport.lower()
-        )
+@app.post("/analyze/batch", status_code=202)
+async def submit_batch(request: Request):
+    """
+    Queue many videos of one sport for analysis as a batch
 
-        return {
-            "status": "success",
-            "sport": sport,
-            "analysis": analysis_data,
-            "analysis_file": str(analysis_output_path),
-            "annotated_video": str(annotated_video_path) if annotated_video_path.exists() else None
-        }
+    Form fields (multipart/form-data): sport, one videos part per clip,
+    and refresh, as in /analyze.
 
-    except Exception as e:
-        print(f"Error during analysis: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    Gemini and speech synthesis run for several clips at once while the
+    clips already analysed are annotated on every core. Each upload is
+    checked as in /analyze; if any is rejected, none are queued.
 
-    finally:
-        if video_path.exists():
-            video_path.unlink()
+    Returns:
+    - batch_id: ID to poll at /batches/{batch_id}
+    - status_url: Where to poll
+    - clips: number of videos queued
+    """
 
-@app.get("/download/analysis")
-async def download_analysis():
-    """Download the analysis JSON file"""
-    analysis_path = OUTPUT_DIR / "sports.json"
+    try:
+        fields, uploads = await read_upload_form(request, UPLOAD_DIR, max_files=BATCH_MAX_CLIPS)
+    except UploadRejected as e:
+        detail = f"{e.filename}: {e.detail}" if e.filename else e.detail
+        raise HTTPException(status_code=e.status_code, detail=detail)
 
-    if not analysis_path.exists():
-        raise HTTPException(status_code=404, detail="Analysis file not found")
+    try:
+        sport = form_sport(fields)
+        refresh = form_flag(fields, 'refresh')
+        if not uploads:
+            raise HTTPException(status_code=400, detail="No videos uploaded")
+        batch_id = batch_manager.submit([(upload['path'], sport, upload['sha256'], upload['filename'] or upload['path'])
+                                         for upload in uploads], str(OUTPUT_DIR), refresh)
 
-    return FileResponse(
-        path=analysis_path,
-        media_type="application/json",
-        filename="sports.json"
-    )
+    except JobQueueFull as e:
+        remove_uploads(uploads)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "60"})
 
-@app.get("/download/video/{sport}")
-async def download_annotated_video(sport: str):
-    """Download the annotated video file"""
-    video_path = OUTPUT_DIR / f"{sport}_annotated.mp4"
+    except BaseException:
+        remove_uploads(uploads)
+        raise
 
-    if not video_path.exists():
-        raise HTTPException(status_code=404, detail="Annotated video not found")
+    print(f"Queued batch {batch_id}: {len(uploads)} {sport} videos")
+    return {
+        "batch_id": batch_id,
+        "status": "queued",
+        "sport": sport,
+        "status_url": f"/batches/{batch_id}",
+        "clips": len(uploads)
+    }
+
+@app.get("/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    """Status of a batch, per clip, with throughput once it has finished"""
+    batch = batch_manager.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    clips = []
+    for i, clip in enumerate(batch['clips']):
+        clip = {key: clip[key] for key in ('video', 'sport', 'status', 'error', 'frames')}
+        if clip['status'] == 'done':
+            clip["analysis_url"] = f"/batches/{batch_id}/clips/{i}/analysis"
+            clip["video_url"] = f"/batches/{batch_id}/clips/{i}/video"
+        clips.append(clip)
+    return {
+        "batch_id": batch_id,
+        "status": batch['status'],
+        "created_at": batch['created_at'],
+        "started_at": batch['started_at'],
+        "finished_at": batch['finished_at'],
+        "error": batch['error'],
+        "clips": clips,
+        "summary": batch['summary']
+    }
+
+@app.get("/batches/{batch_id}/clips/{index}/{name}")
+async def get_batch_clip_result(batch_id: str, index: int, name: str, request: Request):
+    """Download a finished clip's analysis JSON or annotated video"""
+    batch = batch_manager.get(batch_id)
+    if batch is None or not 0 <= index < len(batch['clips']) or name not in ("analysis", "video"):
+        raise HTTPException(status_code=404, detail="Result file not found")
+
+    clip = batch['clips'][index]
+    if clip['status'] != 'done':
+        raise HTTPException(status_code=409, detail=f"Clip is {clip['status']}")
+    key = clip['analysis' if name == "analysis" else 'annotated_video']
+    if not key:
+        raise HTTPException(status_code=404, detail="Result file not found")
+
+    stem = os.path.splitext(os.path.basename(clip['video']))[0]
+    if name == "analysis":
+        return stored_file_response(request, key, "application/json", f"{stem}_analysis.json")
+    return stored_file_response(request, key, "video/mp4", f"{stem}_{clip['sport']}_annotated.mp4")
+
+def get_job_or_404(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+def get_job_result(job_id, name):
+    """Output store key of a finished job's result"""
+    job = get_job_or_404(job_id)
+    if job['status'] == 'failed':
+        raise HTTPException(status_code=409, detail=f"Job failed: {job['error']}")
+    if job['status'] != 'done':
+        raise HTTPException(status_code=409, detail=f"Job is still {job['status']}")
+    if not job['result'][name]:
+        raise HTTPException(status_code=404, detail="Result file not found")
+    return job['result'][name]
+
+def is_not_modified(request, etag, mtime):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def stored_file_response(request, key, media_type, filename, cache_control="private, max-age=86400, immutable"):
+    """Serve an output store entry with ETag/Last-Modified validation and Range support
+
+    Keys name immutable content, so the key is a strong ETag and clients
+    may cache the response. URLs whose content can change pass
+    cache_control="no-cache" so clients revalidate against the ETag.
+    Range and If-Range requests are handled by FileResponse.
+    """
+    path = output_store.path(key)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Result has expired")
+
+    stat = os.stat(path)
+    etag = f'"{key.split(".")[0]}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if is_not_modified(request, etag, stat.st_mtime):
+        headers["Last-Modified"] = formatdate(stat.st_mtime, usegmt=True)
+        return Response(status_code=304, headers=headers)
 
     return FileResponse(
-        path=video_path,
-        media_type="video/mp4",
-        filename=f"{sport}_annotated.mp4"
+        path=path,
+        media_type=media_type,
+        filename=filename,
+        headers=headers,
+        stat_result=stat
     )
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status and progress of an analysis job"""
+    job = get_job_or_404(job_id)
+    response = {
+        "job_id": job_id,
+        "sport": job['sport'],
+        "status": job['status'],
+        "stage": job.get('stage', 'queued'),
+        "frames_processed": job.get('frames_processed'),
+        "total_frames": job.get('total_frames'),
+        "created_at": job['created_at'],
+        "finished_at": job['finished_at'],
+        "error": job['error'],
+        "gemini_processing": job.get('gemini_processing')
+    }
+    if job.get('preview'):
+        response["preview_url"] = f"/jobs/{job_id}/preview"
+    if job['stream_dir'] and os.path.exists(os.path.join(job['stream_dir'], STREAM_PLAYLIST)):
+        response["stream_url"] = f"/jobs/{job_id}/stream/{STREAM_PLAYLIST}"
+    if job['status'] == 'done':
+        response["analysis_url"] = f"/jobs/{job_id}/analysis"
+        if job['result']['video']:
+            response["video_url"] = f"/jobs/{job_id}/video"
+    return response
+
+@app.delete("/jobs/{job_id}", status_code=202)
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job
+
+    A running job stops at its next checkpoint (while Gemini processes the
+    upload, or at the next frame-progress update) and then shows as failed.
+    """
+    cancelled = job_manager.cancel(job_id)
+    if cancelled is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not cancelled:
+        raise HTTPException(status_code=409, detail="Job has already finished")
+    return {"job_id": job_id, "status": "cancelling"}
+
+@app.get("/jobs/{job_id}/analysis")
+async def get_job_analysis(job_id: str, request: Request):
+    """Download a finished job's analysis JSON"""
+    key = get_job_result(job_id, 'analysis')
+    return stored_file_response(request, key, "application/json", "sports.json")
+
+@app.get("/jobs/{job_id}/video")
+async def get_job_video(job_id: str, request: Request):
+    """Download a finished job's annotated video (supports Range requests for seeking)"""
+    job = get_job_or_404(job_id)
+    key = get_job_result(job_id, 'video')
+    return stored_file_response(request, key, "video/mp4", f"{job['sport']}_annotated.mp4")
+
+@app.get("/jobs/{job_id}/preview")
+async def get_job_preview(job_id: str, request: Request):
+    """Download a job's low-resolution preview, available while the full video is still rendering"""
+    job = get_job_or_404(job_id)
+    if not job.get('preview'):
+        if job['status'] == 'failed':
+            raise HTTPException(status_code=409, detail=f"Job failed: {job['error']}")
+        if job['status'] == 'done':
+            raise HTTPException(status_code=404, detail="No preview was requested for this job")
+        raise HTTPException(status_code=409, detail=f"Preview is not ready, job is {job.get('stage', 'queued')}")
+    return stored_file_response(request, job['preview'], "video/mp4", f"{job['sport']}_preview.mp4")
+
+@app.get("/jobs/{job_id}/feedback/{index}")
+async def get_job_feedback_audio(job_id: str, index: int):
+    """Spoken feedback for one shot/event of a finished job, as MP3
+
+    The render already synthesised every line, so this is normally served
+    from the speech cache without calling ElevenLabs.
+    """
+    job = get_job_or_404(job_id)
+    path = output_store.path(get_job_result(job_id, 'analysis'))
+    if path is None:
+        raise HTTPException(status_code=404, detail="Result has expired")
+    async with aiofiles.open(path, 'r') as f:
+        items = json.loads(await f.read()).get(ITEM_KEYS[job['sport']], [])
+    if not 0 <= index < len(items):
+        raise HTTPException(status_code=404, detail="Feedback item not found")
+
+    fd, audio_path = tempfile.mkstemp(suffix=".mp3", dir=UPLOAD_DIR)
+    os.close(fd)
+    try:
+        await agenerate_speech(items[index]['feedback'], audio_path)
+    except Exception as e:
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+        raise HTTPException(status_code=502, detail=f"Could not generate speech: {e}")
+
+    return FileResponse(audio_path, media_type="audio/mpeg", filename=f"{job['sport']}_feedback_{index}.mp3",
+                        background=BackgroundTask(os.remove, audio_path))
+
+@app.get("/jobs/{job_id}/stream/{name}")
+async def get_job_stream(job_id: str, name: str):
+    """Serve a job's HLS playlist and fMP4 segments, while the video renders and after
+
+    The playlist grows as segments are finished and ends with
+    #EXT-X-ENDLIST once the render is done, so it is never cached.
+    Segments never change once listed.
+    """
+    job = get_job_or_404(job_id)
+    if not job['stream_dir']:
+        raise HTTPException(status_code=404, detail="Streaming was not requested for this job")
+    if not STREAM_FILE_PATTERN.match(name):
+        raise HTTPException(status_code=404, detail="Stream file not found")
+
+    path = os.path.join(job['stream_dir'], name)
+    if not os.path.exists(path):
+        if name == STREAM_PLAYLIST and job['status'] in ('queued', 'running'):
+            raise HTTPException(status_code=409, detail=f"Stream has not started, job is {job.get('stage', 'queued')}",
+                                headers={"Retry-After": "2"})
+        raise HTTPException(status_code=404, detail="Stream file not found")
+
+    if name == STREAM_PLAYLIST:
+        return FileResponse(path, media_type="application/vnd.apple.mpegurl", headers={"Cache-Control": "no-cache"})
+    media_type = "video/mp4" if name.endswith(".mp4") else "video/iso.segment"
+    return FileResponse(path, media_type=media_type, headers={"Cache-Control": "private, max-age=86400, immutable"})
+
+@app.get("/download/analysis")
+async def download_analysis(request: Request):
+    """Download the analysis JSON file of the most recently finished job"""
+    job_id = job_manager.latest()
+    if job_id is None:
+        raise HTTPException(status_code=404, detail="Analysis file not found")
+    # A later job changes what this URL serves, so it is never cached without revalidation
+    key = get_job_result(job_id, 'analysis')
+    return stored_file_response(request, key, "application/json", "sports.json", cache_control="no-cache")
+
+@app.get("/download/video/{sport}")
+async def download_annotated_video(sport: str, request: Request):
+    """Download the annotated video of the most recently finished job for a sport"""
+    job_id = job_manager.latest(sport)
+    if job_id is None:
+        raise HTTPException(status_code=404, detail="Annotated video not found")
+    key = get_job_result(job_id, 'video')
+    return stored_file_response(request, key, "video/mp4", f"{sport}_annotated.mp4", cache_control="no-cache")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,77 @@
+import os
+import re
+import time
+from common import file_sha256
+
+OUTPUT_STORE_DIR = os.getenv("OUTPUT_STORE_DIR", os.path.join("outputs", "store"))
+OUTPUT_STORE_TTL = float(os.getenv("OUTPUT_STORE_TTL", 24 * 3600))
+OUTPUT_STORE_MAX_BYTES = int(os.getenv("OUTPUT_STORE_MAX_BYTES", 5 * 1024 ** 3))
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}(\.[a-z0-9]+)?$')
+
+class OutputStore:
+    """Finished job outputs, stored once per content hash
+
+    A key is the sha256 of the file plus its extension, so identical
+    outputs share one file and a key always names the same bytes, which
+    makes it usable as a strong ETag. Files are renamed into place, so
+    worker processes can add to the store concurrently and readers never
+    see a partial file. Entries expire ttl seconds after they were last
+    added; the oldest go first once the store holds more than max_bytes.
+    """
+
+    def __init__(self, root=OUTPUT_STORE_DIR, ttl=OUTPUT_STORE_TTL, max_bytes=OUTPUT_STORE_MAX_BYTES):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        """Path of a live entry, or None if the key is unknown or expired"""
+        if not KEY_PATTERN.match(key):
+            return None
+        path = os.path.join(self.root, key[:2], key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, source_path, suffix=''):
+        """Move source_path into the store and return its key"""
+        key = file_sha256(source_path) + suffix.lower()
+
+        directory = os.path.join(self.root, key[:2])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, key)
+        if os.path.exists(path):
+            os.remove(source_path)
+            os.utime(path)
+        else:
+            os.replace(source_path, path)
+        self.evict()
+        return key
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not KEY_PATTERN.match(name):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,69 @@
+"""Pooled vs unpooled text-to-speech calls against the local stub server
+
+Times the same number of requests made through voice.py's shared
+session and httpx client, which keep their connections open, and with a
+new connection per call, which is how voice.py worked before pooling.
+Run from the repository root: python tests/bench_tts_pool.py
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import requests
+
+import voice
+from tts_server import StubTTSServer
+
+def sync_pooled(calls, output_path):
+    for i in range(calls):
+        voice.download_speech(*voice.speech_request(f"Line {i}"), output_path)
+
+def sync_unpooled(calls, output_path):
+    for i in range(calls):
+        url, headers, data = voice.speech_request(f"Line {i}")
+        response = requests.post(url, headers=headers, json=data)
+        with open(output_path, 'wb') as f:
+            f.write(response.content)
+
+async def async_pooled(calls, output_path):
+    for i in range(calls):
+        await voice.adownload_speech(*voice.speech_request(f"Line {i}"), output_path)
+    await voice.aclose_async_client()
+
+async def async_unpooled(calls, output_path):
+    for i in range(calls):
+        url, headers, data = voice.speech_request(f"Line {i}")
+        async with httpx.AsyncClient() as client:
+            response = await client.post(url, headers=headers, json=data)
+        with open(output_path, 'wb') as f:
+            f.write(response.content)
+
+def timed(run):
+    started = time.perf_counter()
+    run()
+    return time.perf_counter() - started
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--calls", type=int, default=500)
+    args = parser.parse_args()
+
+    voice.ELEVENLABS_API_KEY = "bench-key"
+    with StubTTSServer() as server, tempfile.TemporaryDirectory() as temp_dir:
+        voice.ELEVENLABS_API_URL = server.url
+        output_path = os.path.join(temp_dir, "clip.mp3")
+        runs = [
+            ("requests, new connection per call", lambda: sync_unpooled(args.calls, output_path)),
+            ("requests, pooled session", lambda: sync_pooled(args.calls, output_path)),
+            ("httpx, new client per call", lambda: asyncio.run(async_unpooled(args.calls, output_path))),
+            ("httpx, pooled client", lambda: asyncio.run(async_pooled(args.calls, output_path)))
+        ]
+        for name, run in runs:
+            seconds = timed(run)
+            print(f"{name:36} {seconds:6.2f}s  {seconds * 1000 / args.calls:6.2f} ms/call")
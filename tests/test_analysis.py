@@ -0,0 +1,212 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import analysis
+
+def shot(timestamp, result, feedback="Elbow in", shot_type="Jump shot"):
+    return {
+        "timestamp": timestamp,
+        "shot_type": shot_type,
+        "result": result,
+        "total_shots_made_so_far": 0,
+        "total_shots_missed_so_far": 0,
+        "total_layups_made_so_far": 0,
+        "feedback": feedback
+    }
+
+class FakeModel:
+    """Stands in for the Gemini model through analyze_video's model= hook
+
+    respond(video_file) gives the reply text for an uploaded clip. Streamed
+    replies are handed out a few characters at a time.
+    """
+
+    def __init__(self, respond, chunk_size=7):
+        self.respond = respond
+        self.chunk_size = chunk_size
+        self.calls = []
+
+    def generate_content(self, contents, stream=False):
+        video_file, _ = contents
+        self.calls.append(video_file.name)
+        text = self.respond(video_file)
+        if not stream:
+            return SimpleNamespace(text=text)
+        return (SimpleNamespace(text=text[i:i + self.chunk_size]) for i in range(0, len(text), self.chunk_size))
+
+@pytest.fixture
+def fake_gemini(monkeypatch, tmp_path):
+    """Replace the Gemini file API and the analysis cache with local stand-ins"""
+    monkeypatch.setattr(analysis.genai, "upload_file",
+                        lambda path: SimpleNamespace(name=path, state=SimpleNamespace(name="ACTIVE")))
+    monkeypatch.setattr(analysis.genai, "delete_file", lambda name: None)
+    monkeypatch.setattr(analysis, "analysis_cache", analysis.AnalysisCache(str(tmp_path / "analysis_cache")))
+
+    video_path = tmp_path / "clip.mp4"
+    video_path.write_bytes(b"not really a video")
+    return str(video_path)
+
+def test_analysis_windows_cover_the_video_once():
+    windows = analysis.analysis_windows(700, 300, 20)
+
+    assert [(start, end) for start, end, _, _ in windows] == [(0, 300), (280, 580), (560, 700)]
+    assert windows[0][2] == 0
+    assert windows[-1][3] == float('inf')
+    for (_, _, _, keep_until), (start, _, keep_from, _) in zip(windows, windows[1:]):
+        # Each hand-over sits in the middle of the overlap
+        assert keep_until == keep_from == start + 10
+
+def test_short_video_is_one_window():
+    assert analysis.analysis_windows(42, 300, 20) == [(0.0, 42, 0.0, float('inf'))]
+
+@pytest.mark.parametrize("window_seconds, overlap_seconds", [(20, 20), (20, 30), (0, 0), (300, -1)])
+def test_windows_that_cannot_advance_are_rejected(window_seconds, overlap_seconds):
+    with pytest.raises(ValueError):
+        analysis.analysis_windows(700, window_seconds, overlap_seconds)
+
+def test_merge_window_results_shifts_dedupes_and_recounts():
+    windows = analysis.analysis_windows(500, 300, 20)
+    # The hand-over is at 4:50. The miss at 4:49.8 is also reported by the
+    # second window, 0.5s late and on its side of the hand-over.
+    first = {"shots": [shot("0:10.0", "made", shot_type="Layup"), shot("4:49.8", "missed")]}
+    second = {"shots": [shot("0:09.0", "made"), shot("0:10.3", "missed"), shot("1:00.0", "made")]}
+
+    merged = analysis.merge_window_results("basketball", list(zip(windows, [first, second])))
+
+    # 0:09.0 in the second window is 4:49, which belongs to the first
+    assert [s["timestamp"] for s in merged["shots"]] == ["0:10.0", "4:49.8", "5:40.0"]
+    assert [s["total_shots_made_so_far"] for s in merged["shots"]] == [1, 1, 2]
+    assert [s["total_shots_missed_so_far"] for s in merged["shots"]] == [0, 1, 1]
+    assert [s["total_layups_made_so_far"] for s in merged["shots"]] == [1, 1, 1]
+
+def test_merge_window_results_keeps_distinct_outcomes_in_the_overlap():
+    windows = analysis.analysis_windows(500, 300, 20)
+    first = {"events": [{"timestamp": "4:49.0", "event_type": "pass", "player_action": "", "feedback": ""}]}
+    second = {"events": [{"timestamp": "0:10.5", "event_type": "goal", "player_action": "", "feedback": ""}]}
+
+    merged = analysis.merge_window_results("soccer", list(zip(windows, [first, second])))
+
+    assert [e["event_type"] for e in merged["events"]] == ["pass", "goal"]
+
+def test_streaming_parser_yields_items_as_they_close():
+    items = [shot("0:01.0", "made", feedback='Said "nice" {really} [twice] \\ ok'),
+             shot("0:02.0", "missed", feedback="Legs }]")]
+    response = "```json\n" + json.dumps({"shots": items, "notes": [{"ignored": True}]}, indent=2) + "\n```"
+
+    parser = analysis.StreamingItemParser("shots")
+    seen = []
+    for i, char in enumerate(response):
+        for item in parser.feed(char):
+            seen.append((i, item))
+
+    assert [item for _, item in seen] == items
+    # The first shot is handed out before the second one has even started
+    assert seen[0][0] < response.index('"0:02.0"')
+    assert parser.done
+
+def test_analyze_video_streams_items_through_a_fake_model(fake_gemini, tmp_path):
+    reply = json.dumps({"shots": [shot("0:03.0", "made"), shot("0:07.5", "missed")]})
+    model = FakeModel(lambda video_file: reply)
+    streamed = []
+
+    output_path = str(tmp_path / "sports.json")
+    data = analysis.analyze_video(fake_gemini, "basketball", output_path, proxy_settings=None,
+                                  window_seconds=None, model=model, on_item=streamed.append)
+
+    assert [s["timestamp"] for s in streamed] == ["0:03.0", "0:07.5"]
+    assert data == json.loads(reply)
+    with open(output_path) as f:
+        assert json.load(f) == data
+
+    # Same clip, prompt and settings: answered from the cache
+    again = analysis.analyze_video(fake_gemini, "basketball", output_path, proxy_settings=None,
+                                   window_seconds=None, model=model)
+    assert again == data
+    assert len(model.calls) == 1
+
+def test_analyze_video_merges_windows_from_a_fake_model(fake_gemini, monkeypatch, tmp_path):
+    monkeypatch.setattr(analysis, "video_duration", lambda path: 500)
+    monkeypatch.setattr(analysis.shutil, "which", lambda name: "/usr/bin/" + name)
+
+    def transcode(video_path, clip_path, settings=None, start=None, duration=None):
+        with open(clip_path, "wb") as f:
+            f.write(b"window")
+        return clip_path
+    monkeypatch.setattr(analysis, "transcode_for_analysis", transcode)
+
+    replies = {
+        "window_0.mp4": {"shots": [shot("0:10.0", "made"), shot("4:49.8", "missed")]},
+        "window_1.mp4": {"shots": [shot("0:10.3", "missed"), shot("1:00.0", "made")]}
+    }
+    model = FakeModel(lambda video_file: json.dumps(replies[os.path.basename(video_file.name)]))
+    streamed = []
+
+    data = analysis.analyze_video(fake_gemini, "basketball", str(tmp_path / "sports.json"), proxy_settings=None,
+                                  window_seconds=300, window_overlap=20, model=model, on_item=streamed.append)
+
+    assert [s["timestamp"] for s in data["shots"]] == ["0:10.0", "4:49.8", "5:40.0"]
+    assert [s["total_shots_made_so_far"] for s in data["shots"]] == [1, 1, 2]
+    # Streaming only applies the keep ranges, so the overlap's miss comes from both windows
+    assert sorted(s["timestamp"] for s in streamed) == ["0:10.0", "4:49.8", "4:50.3", "5:40.0"]
+    assert sorted(os.path.basename(name) for name in model.calls) == ["window_0.mp4", "window_1.mp4"]
+
+def test_window_processing_waits_share_one_event_loop(fake_gemini, monkeypatch, tmp_path):
+    monkeypatch.setattr(analysis, "video_duration", lambda path: 1000)
+    monkeypatch.setattr(analysis.shutil, "which", lambda name: "/usr/bin/" + name)
+    monkeypatch.setattr(analysis, "transcode_for_analysis",
+                        lambda video_path, clip_path, *args: open(clip_path, "wb").close())
+    monkeypatch.setattr(analysis.genai, "upload_file",
+                        lambda path: SimpleNamespace(name=path, state=SimpleNamespace(name="PROCESSING")))
+    monkeypatch.setattr(analysis.genai, "get_file",
+                        lambda name: SimpleNamespace(name=name, state=SimpleNamespace(name="ACTIVE")))
+    monkeypatch.setattr(analysis, "file_poller", analysis.FileProcessingPoller(min_interval=0.2, max_interval=0.2))
+    poll = analysis.file_poller.poll
+    waiting = {'now': 0, 'most': 0}
+    loops = set()
+
+    async def tracked_poll(*args, **kwargs):
+        loops.add((asyncio.get_running_loop(), threading.get_ident()))
+        waiting['now'] += 1
+        waiting['most'] = max(waiting['most'], waiting['now'])
+        try:
+            return await poll(*args, **kwargs)
+        finally:
+            waiting['now'] -= 1
+    monkeypatch.setattr(analysis.file_poller, "poll", tracked_poll)
+
+    model = FakeModel(lambda video_file: '{"shots": []}')
+    analysis.analyze_video(fake_gemini, "basketball", str(tmp_path / "sports.json"), proxy_settings=None,
+                           window_seconds=300, window_overlap=20, max_workers=4, model=model)
+
+    assert len(model.calls) == 4
+    # One loop on one thread polled every window, all at once
+    assert len(loops) == 1
+    assert waiting['most'] == 4
+
+def test_cancel_event_stops_the_processing_wait(monkeypatch):
+    processing = SimpleNamespace(name="files/clip", state=SimpleNamespace(name="PROCESSING"))
+    monkeypatch.setattr(analysis.genai, "get_file", lambda name: processing)
+    poller = analysis.FileProcessingPoller(timeout=30, min_interval=0.05, max_interval=0.05)
+    cancel_event = threading.Event()
+    threading.Timer(0.2, cancel_event.set).start()
+
+    start = time.perf_counter()
+    with pytest.raises(analysis.AnalysisCancelled):
+        asyncio.run(poller.poll(processing, 1, cancel_event=cancel_event))
+    assert time.perf_counter() - start < 5
+
+def test_cancelled_analysis_never_reaches_the_model(fake_gemini, tmp_path):
+    model = FakeModel(lambda video_file: '{"shots": []}')
+    cancel_event = threading.Event()
+    cancel_event.set()
+
+    with pytest.raises(analysis.AnalysisCancelled):
+        analysis.analyze_video(fake_gemini, "basketball", str(tmp_path / "sports.json"), proxy_settings=None,
+                               window_seconds=None, model=model, cancel_event=cancel_event)
+    assert model.calls == []
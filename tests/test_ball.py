@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+from ball import EventTimeline
+
+def reference_lookups(events, frame_count):
+    """last_fired and active by scanning every event"""
+    ordered = sorted(events, key=lambda e: e['frame_number'])
+    last_fired = active = None
+    for event in ordered:
+        if event['frame_number'] <= frame_count:
+            last_fired = event
+            if frame_count <= event['feedback_end_frame']:
+                active = event
+    return last_fired, active
+
+def event(frame_number, length, name):
+    return {'frame_number': frame_number, 'feedback_end_frame': frame_number + length, 'feedback': name}
+
+def test_overlapping_feedback_goes_to_the_most_recent_event():
+    first, second = event(10, 100, 'first'), event(50, 20, 'second')
+    timeline = EventTimeline([second, first])
+
+    assert timeline.last_fired(9) is None
+    assert timeline.active(9) is None
+    assert timeline.active(10) is first
+    assert timeline.active(50) is second
+    assert timeline.active(70) is second
+    # Once the later window closes, the earlier one shows again
+    assert timeline.active(71) is first
+    assert timeline.active(110) is first
+    assert timeline.active(111) is None
+    assert timeline.last_fired(111) is second
+
+def test_same_frame_events_keep_analysis_order():
+    a, b = event(30, 10, 'a'), event(30, 10, 'b')
+    timeline = EventTimeline([a, b])
+
+    assert timeline.last_fired(30) is b
+    assert timeline.active(35) is b
+
+@pytest.mark.parametrize("seed", range(20))
+def test_lookups_match_a_linear_scan(seed):
+    rng = random.Random(seed)
+    events = [event(rng.randint(0, 300), rng.randint(0, 120), str(i)) for i in range(rng.randint(0, 25))]
+    timeline = EventTimeline(events)
+
+    for frame_count in range(-1, 450):
+        last_fired, active = reference_lookups(events, frame_count)
+        assert timeline.last_fired(frame_count) is last_fired
+        assert timeline.active(frame_count) is active
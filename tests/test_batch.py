@@ -0,0 +1,81 @@
+import os
+import threading
+
+import batch
+import output_store
+
+def test_read_manifest(tmp_path):
+    manifest = tmp_path / "clips.txt"
+    manifest.write_text("# practice session\n"
+                        "a.mp4\n"
+                        "\n"
+                        "  sub/b.mov , Tennis \n"
+                        "/abs/c.mp4,soccer\n")
+
+    assert batch.read_manifest(str(manifest), "basketball") == [
+        (str(tmp_path / "a.mp4"), "basketball"),
+        (str(tmp_path / "sub" / "b.mov"), "tennis"),
+        ("/abs/c.mp4", "soccer")
+    ]
+
+def test_clip_output_dirs_are_unique():
+    clips = [("one/serve.mp4", "tennis"), ("two/serve.mp4", "tennis"), ("rally.mov", "tennis"),
+             ("three/serve.mkv", "tennis")]
+
+    assert batch.clip_output_dirs(clips, "out") == [
+        os.path.join("out", "serve"),
+        os.path.join("out", "serve-2"),
+        os.path.join("out", "rally"),
+        os.path.join("out", "serve-3")
+    ]
+
+def test_throughput_summary():
+    results = [{'status': 'done', 'frames': 300}, {'status': 'done', 'frames': 600},
+               {'status': 'failed', 'frames': 0}]
+
+    summary = batch.throughput_summary(results, 60)
+    assert summary == {
+        'clips': 3,
+        'succeeded': 2,
+        'failed': 1,
+        'frames': 900,
+        'wall_seconds': 60,
+        'clips_per_hour': 120.0,
+        'frames_per_second': 15.0
+    }
+    assert batch.throughput_summary(results, 0)['clips_per_hour'] is None
+
+def test_outputs_are_stored_off_the_callback_thread(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    callback_thread = []
+
+    def fake_run_batch(clips, work_dir, use_cache, video_hashes, on_update):
+        clip_dir = os.path.join(work_dir, "serve")
+        os.makedirs(clip_dir)
+        result = {'status': 'done', 'error': None, 'frames': 10,
+                  'analysis_path': os.path.join(clip_dir, "analysis.json"),
+                  'video_output_path': os.path.join(clip_dir, "tennis_annotated.mp4")}
+        for path in (result['analysis_path'], result['video_output_path']):
+            with open(path, 'w') as f:
+                f.write(path)
+        callback_thread.append(threading.current_thread())
+        on_update(0, result)
+        return {'results': []}
+
+    monkeypatch.setattr(batch, "run_batch", fake_run_batch)
+    stored_on = []
+    put = output_store.OutputStore.put
+    monkeypatch.setattr(output_store.OutputStore, "put",
+                        lambda self, *args: stored_on.append(threading.current_thread()) or put(self, *args))
+
+    manager = batch.BatchManager()
+    upload = tmp_path / "serve.mp4"
+    upload.write_bytes(b"video")
+    batch_id = manager.submit([(str(upload), "tennis", "hash", "serve.mp4")], str(tmp_path / "work"))
+    manager.executor.shutdown(wait=True)
+
+    clip = manager.get(batch_id)['clips'][0]
+    assert clip['status'] == 'done'
+    assert clip['analysis'].endswith('.json') and clip['annotated_video'].endswith('.mp4')
+    assert stored_on and callback_thread[0] not in stored_on
+    assert not upload.exists()
@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import os
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import ingest
+
+BOUNDARY = "testboundary"
+MP4_HEAD = b'\x00\x00\x00\x18ftypmp42' + bytes(200)
+
+def form_body(fields, files):
+    """multipart/form-data parts for fields and (name, filename, content_type, data) files"""
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, content_type, data in files:
+        parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b'\r\n')
+    return b''.join(parts) + f'--{BOUNDARY}--\r\n'.encode()
+
+@pytest.fixture
+def post(monkeypatch, tmp_path):
+    monkeypatch.setattr(ingest, "probe_video", lambda path: {'fps': 30.0, 'width': 64, 'height': 48, 'duration': 1.0})
+
+    async def upload(request):
+        try:
+            fields, uploads = await ingest.read_upload_form(request, str(tmp_path), max_bytes=4096, max_files=2)
+        except ingest.UploadRejected as e:
+            return JSONResponse({'detail': e.detail, 'filename': e.filename}, status_code=e.status_code)
+        return JSONResponse({'fields': fields, 'uploads': uploads})
+
+    app = Starlette(routes=[Route("/upload", upload, methods=["POST"])])
+
+    def post(content):
+        async def send():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post("/upload", content=content,
+                                         headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+        return asyncio.run(send())
+
+    return post
+
+def test_fields_and_files_are_read(post, tmp_path):
+    video = MP4_HEAD + b'frames' * 100
+    response = post(form_body({'sport': 'tennis', 'refresh': 'true'}, [('video', 'clip.mp4', 'video/mp4', video)]))
+
+    assert response.status_code == 200
+    assert response.json()['fields'] == {'sport': 'tennis', 'refresh': 'true'}
+    upload, = response.json()['uploads']
+    assert upload['filename'] == 'clip.mp4'
+    assert upload['container'] == 'mp4'
+    assert upload['size'] == len(video)
+    assert upload['sha256'] == hashlib.sha256(video).hexdigest()
+    with open(upload['path'], 'rb') as f:
+        assert f.read() == video
+
+def test_non_video_is_refused_before_the_rest_is_read(post, tmp_path):
+    body = form_body({}, [('video', 'notes.mp4', 'video/mp4', b'plain text, not a video' * 20 + bytes(2000))])
+    sent = []
+
+    async def chunks():
+        for start in range(0, len(body), 256):
+            sent.append(start)
+            yield body[start:start + 256]
+
+    response = post(chunks())
+    assert response.status_code == 415
+    assert response.json()['filename'] == 'notes.mp4'
+    assert len(sent) < len(body) // 256
+    assert os.listdir(tmp_path) == []
+
+def test_chunked_upload_over_the_limit_is_refused(post, tmp_path):
+    body = form_body({'sport': 'tennis'}, [('video', 'big.mp4', 'video/mp4', MP4_HEAD + bytes(8192))])
+
+    async def chunks():
+        for start in range(0, len(body), 1024):
+            yield body[start:start + 1024]
+
+    response = post(chunks())
+    assert response.status_code == 413
+    assert os.listdir(tmp_path) == []
+
+def test_too_many_files_and_malformed_bodies_are_refused(post, tmp_path):
+    three = [('videos', f'{i}.mp4', 'video/mp4', MP4_HEAD) for i in range(3)]
+    assert post(form_body({}, three)).status_code == 400
+    assert post(form_body({}, [('video', 'a.txt', 'text/plain', b'hi')])).status_code == 400
+    assert post(form_body({'sport': 'tennis'}, [])[:-10]).status_code == 400
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,72 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import jobs
+import voice
+
+def quiet_worker():
+    pass
+
+def fake_run_job(job_id, video_path, *args):
+    # Stands in for a worker killed mid-job, e.g. by the OOM killer
+    if video_path == "crash":
+        os._exit(1)
+    if video_path == "slow":
+        time.sleep(1)
+    return {'video': video_path}
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(jobs, "warm_worker", quiet_worker)
+    monkeypatch.setattr(jobs, "run_job", fake_run_job)
+    manager = jobs.JobManager(workers=1, queue_limit=4)
+    yield manager
+    manager.shutdown()
+
+def wait_for(manager, job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = manager.get(job_id)
+        if job['finished_at'] is not None:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} did not finish")
+
+def test_dead_worker_fails_its_job_and_the_pool_recovers(manager, tmp_path):
+    crashed = wait_for(manager, manager.submit("crash", "tennis", "hash", False, str(tmp_path)))
+    assert crashed['status'] == 'failed'
+    assert "Worker process died" in crashed['error']
+
+    job = wait_for(manager, manager.submit("clip.mp4", "tennis", "hash", False, str(tmp_path)))
+    assert job['status'] == 'done'
+    assert job['result'] == {'video': "clip.mp4"}
+
+def test_cancelled_queued_job_removes_its_upload(manager, tmp_path):
+    upload = tmp_path / "upload.mp4"
+    upload.write_bytes(b"video")
+    # The pool hands a job or two beyond the busy worker to its call queue, where they can't be cancelled
+    for path in ("slow", "filler.mp4", "filler.mp4"):
+        manager.submit(path, "tennis", "hash", False, str(tmp_path))
+    job_id = manager.submit(str(upload), "tennis", "hash", False, str(tmp_path))
+
+    assert manager.cancel(job_id)
+    job = wait_for(manager, job_id)
+    assert job['status'] == 'failed'
+    assert job['error'] == "Job was cancelled"
+    assert not upload.exists()
+    assert not (tmp_path / "jobs" / job_id).exists()
+
+def test_prefetch_requests_each_line_once_across_threads(monkeypatch):
+    requested = []
+    monkeypatch.setattr(voice, "prefetch_speech", requested.append)
+    items = [{'feedback': f"Line {i % 5}"} for i in range(200)] + [{'feedback': None}, {}]
+
+    with ThreadPoolExecutor(max_workers=2) as tts_pool, ThreadPoolExecutor(max_workers=8) as windows:
+        prefetch = jobs.FeedbackPrefetch(tts_pool)
+        list(windows.map(prefetch, items))
+        prefetch.wait()
+
+    assert sorted(requested) == [f"Line {i}" for i in range(5)]
@@ -0,0 +1,52 @@
+import os
+import time
+
+import pytest
+
+import ball
+import voice
+from tts_server import StubTTSServer
+
+@pytest.fixture
+def tts_server(monkeypatch, tmp_path):
+    with StubTTSServer(latency=0.5, fail_texts={"fail"}) as server:
+        cache = voice.SpeechCache(str(tmp_path / "tts_cache"))
+        monkeypatch.setattr(voice, "ELEVENLABS_API_URL", server.url)
+        monkeypatch.setattr(voice, "ELEVENLABS_API_KEY", "test-key")
+        monkeypatch.setattr(voice, "speech_cache", cache)
+        monkeypatch.setattr(ball, "speech_cache", cache)
+        yield server
+
+def test_clips_are_synthesised_concurrently(tts_server, tmp_path):
+    speech = [(i * 30, f"Feedback line {i}") for i in range(4)]
+
+    start = time.perf_counter()
+    audio_files = ball.SpeechJobs(speech, str(tmp_path), max_workers=4).result()
+    elapsed = time.perf_counter() - start
+
+    assert [frame for frame, _ in audio_files] == [0, 30, 60, 90]
+    assert all(os.path.getsize(path) > 0 for _, path in audio_files)
+    assert tts_server.max_active == 4
+    # One at a time would take four times the latency
+    assert elapsed < 2 * tts_server.latency
+
+def test_failed_clip_only_warns(tts_server, tmp_path, capsys):
+    speech = [(0, "Good follow-through"), (30, "fail"), (60, "Bend your knees")]
+
+    audio_files = ball.SpeechJobs(speech, str(tmp_path)).result()
+
+    assert [frame for frame, _ in audio_files] == [0, 60]
+    assert "Warning: Could not generate audio for feedback 1" in capsys.readouterr().out
+
+def test_cached_clips_are_not_requested_again(tts_server, tmp_path):
+    speech = [(0, "Good follow-through"), (30, "Bend your knees")]
+    (tmp_path / "first").mkdir()
+    (tmp_path / "second").mkdir()
+    first = ball.SpeechJobs(speech, str(tmp_path / "first"))
+    assert not first.cached
+    first.result()
+
+    second = ball.SpeechJobs(speech, str(tmp_path / "second"))
+    assert second.cached
+    assert len(second.result()) == 2
+    assert sorted(tts_server.texts) == sorted(text for _, text in speech)
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+import voice
+from tts_server import StubTTSServer
+
+@pytest.fixture
+def tts_cache(monkeypatch, tmp_path):
+    cache = voice.SpeechCache(str(tmp_path / "tts_cache"))
+    monkeypatch.setattr(voice, "ELEVENLABS_API_KEY", "test-key")
+    monkeypatch.setattr(voice, "speech_cache", cache)
+    return cache
+
+def test_agenerate_speech_matches_generate_speech(monkeypatch, tmp_path, tts_cache):
+    with StubTTSServer() as server:
+        monkeypatch.setattr(voice, "ELEVENLABS_API_URL", server.url)
+        async_path = asyncio.run(voice.agenerate_speech("Good follow-through", str(tmp_path / "async.mp3")))
+        sync_path = voice.generate_speech("Good follow-through", str(tmp_path / "sync.mp3"))
+
+    with open(async_path, 'rb') as f:
+        assert f.read() == b'ID3Good follow-through'
+    with open(sync_path, 'rb') as f:
+        assert f.read() == b'ID3Good follow-through'
+    # The second call was served from the cache the first one filled
+    assert server.texts == ["Good follow-through"]
+    assert (tts_cache.hits, tts_cache.misses) == (1, 1)
+
+def test_agenerate_speech_retries_read_timeouts(monkeypatch, tmp_path, tts_cache):
+    monkeypatch.setattr(voice, "TTS_READ_TIMEOUT", 0.2)
+    with StubTTSServer(first_latencies=[1.0]) as server:
+        monkeypatch.setattr(voice, "ELEVENLABS_API_URL", server.url)
+        path = asyncio.run(voice.agenerate_speech("Bend your knees", str(tmp_path / "clip.mp3")))
+
+    with open(path, 'rb') as f:
+        assert f.read() == b'ID3Bend your knees'
+    assert server.texts == ["Bend your knees", "Bend your knees"]
+
+def test_dropped_bodies_are_retried_by_both_paths(monkeypatch, tmp_path, tts_cache):
+    with StubTTSServer(truncated=2) as server:
+        monkeypatch.setattr(voice, "ELEVENLABS_API_URL", server.url)
+        sync_path = voice.generate_speech("Follow through", str(tmp_path / "sync.mp3"), use_cache=False)
+        async_path = asyncio.run(voice.agenerate_speech("Follow through", str(tmp_path / "async.mp3"),
+                                                        use_cache=False))
+
+    for path in (sync_path, async_path):
+        with open(path, 'rb') as f:
+            assert f.read() == b'ID3Follow through'
+    assert len(server.texts) == 4
+
+def test_async_client_from_an_earlier_loop_is_closed(monkeypatch, tmp_path, tts_cache):
+    monkeypatch.setattr(voice, "_async_client", None)
+    with StubTTSServer() as server:
+        monkeypatch.setattr(voice, "ELEVENLABS_API_URL", server.url)
+        asyncio.run(voice.agenerate_speech("First", str(tmp_path / "first.mp3")))
+        first = voice._async_client[1]
+
+        async def second():
+            await voice.agenerate_speech("Second", str(tmp_path / "second.mp3"))
+            current = voice._async_client[1]
+            await voice.aclose_async_client()
+            return current
+
+        second_client = asyncio.run(second())
+
+    assert first is not second_client
+    assert first.is_closed and second_client.is_closed
+    assert voice._async_client is None
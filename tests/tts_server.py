@@ -0,0 +1,94 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubTTSServer:
+    """Local stand-in for the ElevenLabs text-to-speech endpoint
+
+    Every request is held for latency seconds before it is answered, so
+    tests can tell concurrent synthesis from sequential; the first requests
+    can be held for first_latencies instead, to run into a client's read
+    timeout. Texts in
+    fail_texts are answered with a 400, which voice.py doesn't retry.
+    Anything else gets a small fake MP3 body; the first truncated of those
+    are cut off halfway and the connection dropped. max_active is the most
+    requests seen in flight at once.
+    """
+
+    def __init__(self, latency=0.0, fail_texts=(), first_latencies=(), truncated=0):
+        self.latency = latency
+        self.first_latencies = list(first_latencies)
+        self.truncated = truncated
+        self.fail_texts = set(fail_texts)
+        self.texts = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections open between requests, as ElevenLabs does
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; don't let Nagle hold the body back
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub.lock:
+                    stub.texts.append(body['text'])
+                    latency = stub.first_latencies.pop(0) if stub.first_latencies else stub.latency
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    time.sleep(latency)
+                    if body['text'] in stub.fail_texts:
+                        self.send_reply(400, 'application/json', b'{"detail": "rejected by stub"}')
+                    else:
+                        with stub.lock:
+                            truncate = stub.truncated > 0
+                            stub.truncated -= truncate
+                        self.send_reply(200, 'audio/mpeg', b'ID3' + body['text'].encode('utf-8'), truncate)
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+
+            def send_reply(self, status, content_type, payload, truncate=False):
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    if truncate:
+                        self.wfile.write(payload[:len(payload) // 2])
+                        self.close_connection = True
+                        return
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
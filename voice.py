@@ -1,18 +1,130 @@
 import os
+import asyncio
+import hashlib
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
 import requests
+import requests.adapters
 from dotenv import load_dotenv
 
 load_dotenv()
 
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 ELEVENLABS_VOICE_ID = os.getenv("ELEVENLABS_VOICE_ID", "EXAVITQu4vr4xnSDxMaL")
+ELEVENLABS_API_URL = os.getenv("ELEVENLABS_API_URL", "https://api.elevenlabs.io")
+ELEVENLABS_MODEL_ID = 'eleven_multilingual_v2'
+VOICE_SETTINGS = {
+    'stability': 0.5,
+    'similarity_boost': 0.5
+}
 
-def generate_speech(text, output_path):
-    """Generate speech from text using ElevenLabs API"""
+TTS_POOL_SIZE = int(os.getenv("TTS_POOL_SIZE", 8))
+TTS_CONNECT_TIMEOUT = float(os.getenv("TTS_CONNECT_TIMEOUT", 10))
+TTS_READ_TIMEOUT = float(os.getenv("TTS_READ_TIMEOUT", 60))
+TTS_RETRIES = int(os.getenv("TTS_RETRIES", 3))
+TTS_BACKOFF = 0.5
+TTS_MAX_BACKOFF = 8.0
+TTS_CHUNK_SIZE = 64 * 1024
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+def link_or_copy(source_path, target_path):
+    """Hard-link source_path to target_path, copying when linking isn't possible"""
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+class SpeechCache:
+    """Generated speech on disk, keyed by everything that affects the audio
+
+    Entries are written to a temporary name and renamed into place, so
+    several processes can share the directory. A hit refreshes the entry's
+    mtime; once the directory holds more than max_bytes, the entries with
+    the oldest mtime are removed first.
+    """
+
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(text, voice_id, model_id, voice_settings):
+        payload = json.dumps([text, voice_id, model_id, voice_settings], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def fetch(self, key, output_path):
+        """Put the cached audio for key at output_path; returns False on a miss"""
+        cache_path = self.path(key)
+        try:
+            link_or_copy(cache_path, output_path)
+            os.utime(cache_path)
+        except FileNotFoundError:
+            # Not cached, or evicted by another process just now
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, audio_path):
+        os.makedirs(self.directory, exist_ok=True)
+        cache_path = self.path(key)
+        temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        link_or_copy(audio_path, temp_path)
+        os.replace(temp_path, cache_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.mp3'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+speech_cache = SpeechCache()
+
+def speech_key(text):
+    """speech_cache key for text spoken with the configured voice, model and settings"""
+    return SpeechCache.key(text, ELEVENLABS_VOICE_ID, ELEVENLABS_MODEL_ID, VOICE_SETTINGS)
+
+def speech_request(text):
+    """URL, headers and JSON body for an ElevenLabs text-to-speech call"""
     if not ELEVENLABS_API_KEY:
         raise ValueError("ELEVENLABS_API_KEY not set in .env file")
 
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}"
+    url = f"{ELEVENLABS_API_URL}/v1/text-to-speech/{ELEVENLABS_VOICE_ID}"
 
     headers = {
         'Accept': 'audio/mpeg',
@@ -22,20 +134,194 @@ def generate_speech(text, output_path):
 
     data = {
         'text': text,
-        'model_id': 'eleven_multilingual_v2',
-        'voice_settings': {
-            'stability': 0.5,
-            'similarity_boost': 0.5
-        }
+        'model_id': ELEVENLABS_MODEL_ID,
+        'voice_settings': VOICE_SETTINGS
     }
+    return url, headers, data
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number attempt + 1
+
+    Uses the server's Retry-After when it gives one in seconds, otherwise
+    exponential backoff with full jitter so parallel callers spread out.
+    """
+    if retry_after:
+        try:
+            return min(TTS_MAX_BACKOFF, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(TTS_MAX_BACKOFF, TTS_BACKOFF * 2 ** attempt))
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """The process-wide requests.Session, keeping up to TTS_POOL_SIZE connections alive"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=TTS_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
 
-    response = requests.post(url, headers=headers, json=data)
+def download_speech(url, headers, data, output_path):
+    """POST a TTS request and stream the audio to output_path, retrying 429/5xx and dropped connections
 
-    if response.status_code != 200:
-        raise Exception(f"ElevenLabs API error: {response.status_code} - {response.text}")
+    A connection that drops or times out partway through the body is
+    retried like one that fails outright.
+    """
+    session = get_session()
+    for attempt in range(TTS_RETRIES + 1):
+        try:
+            with session.post(url, headers=headers, json=data, stream=True,
+                              timeout=(TTS_CONNECT_TIMEOUT, TTS_READ_TIMEOUT)) as response:
+                if response.status_code == 200:
+                    try:
+                        with open(output_path, 'wb') as f:
+                            for chunk in response.iter_content(TTS_CHUNK_SIZE):
+                                f.write(chunk)
+                    except BaseException:
+                        os.remove(output_path)
+                        raise
+                    return
+                if response.status_code not in RETRY_STATUSES or attempt == TTS_RETRIES:
+                    raise Exception(f"ElevenLabs API error: {response.status_code} - {response.text}")
+                delay = retry_delay(attempt, response.headers.get('Retry-After'))
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == TTS_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+        time.sleep(delay)
 
-    with open(output_path, 'wb') as f:
-        f.write(response.content)
+_async_client = None
+
+async def get_async_client():
+    """A pooled httpx.AsyncClient for the running event loop
+
+    A client can't be used from another event loop, so the one built for
+    an earlier loop is closed and replaced.
+    """
+    global _async_client
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    stale = None
+    if _async_client is None or _async_client[0] is not loop:
+        stale = _async_client
+        limits = httpx.Limits(max_connections=TTS_POOL_SIZE, max_keepalive_connections=TTS_POOL_SIZE)
+        timeout = httpx.Timeout(TTS_READ_TIMEOUT, connect=TTS_CONNECT_TIMEOUT)
+        _async_client = (loop, httpx.AsyncClient(limits=limits, timeout=timeout))
+    client = _async_client[1]
+    if stale is not None:
+        await close_client(stale[1])
+    return client
+
+async def close_client(client):
+    try:
+        await client.aclose()
+    except Exception as e:
+        print(f"Warning: Could not close HTTP client: {e}")
+
+async def aclose_async_client():
+    """Close the running loop's pooled client, e.g. from an app shutdown hook"""
+    global _async_client
+    if _async_client is not None and _async_client[0] is asyncio.get_running_loop():
+        client = _async_client[1]
+        _async_client = None
+        await close_client(client)
+
+async def adownload_speech(url, headers, data, output_path):
+    """download_speech for an event loop, using httpx and aiofiles"""
+    import aiofiles
+    import httpx
+
+    client = await get_async_client()
+    for attempt in range(TTS_RETRIES + 1):
+        try:
+            async with client.stream('POST', url, headers=headers, json=data) as response:
+                if response.status_code == 200:
+                    try:
+                        async with aiofiles.open(output_path, 'wb') as f:
+                            async for chunk in response.aiter_bytes(TTS_CHUNK_SIZE):
+                                await f.write(chunk)
+                    except BaseException:
+                        os.remove(output_path)
+                        raise
+                    return
+                body = (await response.aread()).decode(errors='replace')
+                if response.status_code not in RETRY_STATUSES or attempt == TTS_RETRIES:
+                    raise Exception(f"ElevenLabs API error: {response.status_code} - {body}")
+                delay = retry_delay(attempt, response.headers.get('Retry-After'))
+        except (httpx.NetworkError, httpx.TimeoutException, httpx.RemoteProtocolError):
+            if attempt == TTS_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+        await asyncio.sleep(delay)
+
+def fetch_cached_speech(text, output_path, use_cache=True):
+    """Fill output_path from speech_cache if it can; returns (key, hit)
+
+    output_path may be a link into the cache from an earlier call, so it
+    is replaced rather than written through.
+    """
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+
+    key = speech_key(text)
+    if use_cache and speech_cache.fetch(key, output_path):
+        print(f"Audio saved to: {output_path} (cached)")
+        return key, True
+    return key, False
+
+def store_speech(key, output_path, use_cache=True):
+    """Add freshly generated audio to speech_cache; returns output_path"""
+    if use_cache:
+        speech_cache.store(key, output_path)
 
     print(f"Audio saved to: {output_path}")
     return output_path
+
+def generate_speech(text, output_path, use_cache=True):
+    """Generate speech from text using ElevenLabs API
+
+    Audio is reused from speech_cache when the same text was already spoken
+    with the same voice, model and settings.
+    """
+    key, hit = fetch_cached_speech(text, output_path, use_cache)
+    if hit:
+        return output_path
+
+    download_speech(*speech_request(text), output_path)
+    return store_speech(key, output_path, use_cache)
+
+async def agenerate_speech(text, output_path, use_cache=True):
+    """generate_speech for async callers such as FastAPI handlers, on a pooled httpx.AsyncClient"""
+    key, hit = fetch_cached_speech(text, output_path, use_cache)
+    if hit:
+        return output_path
+
+    await adownload_speech(*speech_request(text), output_path)
+    # Storing may evict, which scans the cache directory
+    return await asyncio.to_thread(store_speech, key, output_path, use_cache)
+
+def prefetch_speech(text):
+    """Synthesise text into speech_cache ahead of time, so a later generate_speech is a cache hit
+
+    Errors are only printed; the later call reports them properly.
+    """
+    if speech_cache.contains(speech_key(text)):
+        return
+
+    os.makedirs(speech_cache.directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.prefetch', dir=speech_cache.directory)
+    os.close(fd)
+    try:
+        generate_speech(text, temp_path)
+    except Exception as e:
+        print(f"Warning: Could not prefetch speech: {e}")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)